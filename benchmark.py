@@ -0,0 +1,302 @@
+from __future__ import print_function
+
+#
+# benchmarks for scrrry's hot paths, gathering from a local http stand-in
+# python benchmark.py [results.json] [--pages 200] [--paragraphs 200] [--procs 4] [--workers 16] [--bulk 100000]
+#
+
+from lxml import html
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import scrrry as sc
+
+
+TASK_NAME='benchmark'
+
+# same pattern as template.py, pool workers get their own read-only handle
+if __name__ != '__main__':
+    scr=sc.Scrape_Db(TASK_NAME,ver_check=False,multicall=True)
+
+
+## synthetic pages  ##              ##
+##                  ##              ##
+def synthetic_page(blocks=100,paragraphs=200,seed=0):
+    '''A page with a given number of each of comment/script/style blocks spread between paragraphs.'''
+    parts=['<html><head><title>page '+str(seed)+'</title></head><body>']
+    for n in range(paragraphs):
+        parts.append('<p class="c'+str(n%7)+'">paragraph '+str(n)+' of page '+str(seed)+
+                     ', call +44 20 7946 0'+str(n%1000).zfill(3)+' or mail info'+str(n)+'@example.com</p>')
+        if blocks and n%max(1,int(paragraphs/blocks))==0:
+            parts.append('<!-- comment '+str(n)+' -->')
+            parts.append('<script type="text/javascript">var x'+str(n)+'='+str(n)+'; if(x<2){x++;}</script>')
+            parts.append('<style>.c'+str(n)+'{color:red}</style>')
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+def timeit(funct,repeat=5):
+    '''Best wall time of funct() over repeat runs.'''
+    best=None
+    for _ in range(repeat):
+        t=time.time()
+        funct()
+        t=time.time()-t
+        best=t if best is None or t<best else best
+    return best
+
+
+## http stand-in   ##              ##
+##                  ##              ##
+class _PageHandler(BaseHTTPRequestHandler):
+    protocol_version='HTTP/1.1'
+    disable_nagle_algorithm=True
+
+    def do_GET(self):
+        try:
+            n=int(self.path.strip('/').split('/')[-1])
+        except ValueError:
+            n=-1
+        if not 0<=n<self.server.pages:
+            self.send_response(404)
+            self.send_header('Content-Length','0')
+            self.end_headers()
+            return
+        b=self.server.cache.get(n)
+        if b is None:
+            b=self.server.cache[n]=synthetic_page(self.server.blocks,self.server.paragraphs,n).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type','text/html; charset=utf-8')
+        self.send_header('Content-Length',str(len(b)))
+        self.end_headers()
+        self.wfile.write(b)
+
+    def log_message(self,*args):
+        pass
+
+
+class _ThreadingServer(ThreadingMixIn,HTTPServer):
+    daemon_threads=True
+
+
+def serve(pages=200,paragraphs=200,blocks=20):
+    '''Starts a local server with pages /page/0../page/pages-1 in a background thread, returns (server,urls).'''
+    srv=_ThreadingServer(('127.0.0.1',0),_PageHandler)
+    srv.pages,srv.paragraphs,srv.blocks,srv.cache=pages,paragraphs,blocks,{}
+    threading.Thread(target=srv.serve_forever,daemon=True).start()
+    base='http://127.0.0.1:'+str(srv.server_address[1])+'/page/'
+    return srv,[base+str(n) for n in range(pages)]
+
+
+## cycles           ##              ##
+##                  ##              ##
+NODISPLAY={'type':'none','freq':1,'tick':0}
+
+def gatherTask(it):
+    r=scr.fetch(it)
+    return scr.addTask(it,ctype='html',content=r.text)
+
+
+def scrapeTask(p):
+    h=scr.removeBlocks(scr.parse_task(p))
+    dat={'title':h.xpath('//title')[0].text,'paragraphs':len(h.xpath('//p'))}
+    dat['email']='|'.join(scr.routineFindings(h,what=['email',],context=0))
+    return dat
+
+
+def _cycle(label,*args,**kwargs):
+    t=time.time()
+    rows=scr.taskCycle(*args,**kwargs)
+    t=time.time()-t
+    m=scr.metrics.summary()
+    print('## '+label+' %.3fs - %.1f tasks/s' % (t,m['elements_per_s'] or 0),sep=' ')
+    return {'mode':label,'elapsed_s':t,'elements':m['elements'],'rows':len(rows),'tasks_per_s':m['elements_per_s'],
+            'task_p50':m['task_p50'],'task_p95':m['task_p95'],'db_s':m['db_s'],'callback_s':m['callback_s'],
+            'bytes_in':m['bytes_in'],'bytes_out':m['bytes_out']}
+
+
+def bench_gather(urls,workers=16):
+    results=[]
+    for label,concurrent in [('gather single',{}),('gather concurrent',{'workers':workers,'perhost':workers})]:
+        scr.cursor.execute('DELETE FROM scrapedata;')
+        scr.flush()
+        results.append(_cycle(label,gatherTask,urls,display=NODISPLAY,concurrent=concurrent))
+    return results
+
+
+def bench_scrape(procs=4):
+    results=[]
+    for label,multi in [('scrape single',{}),('scrape multi',{'noofproc':procs})]:
+        scr.clearAllDone(feedback=False)
+        results.append(_cycle(label,scrapeTask,display=NODISPLAY,multi=multi))
+    return results
+
+
+## removeBlocks     ##              ##
+##                  ##              ##
+def removeBlocks_legacy(lxmlhtml,blockstoremove=[['<!--', '-->'],['<script', '</script>'],['<style', '</style>']]):
+    '''removeBlocks as it was up to v0.2.4 (markers encoded so it runs on python 3).'''
+    ht=html.tostring(lxmlhtml)
+    for blk in blockstoremove:
+        b0,b1=blk[0].encode('utf-8'),blk[1].encode('utf-8')
+        while b0 in ht and b1 in ht and b1 in ht[ht.index(b0):]:
+            ht=ht[:ht.index(b0)]+ht[ht.index(b1,ht.index(b0))+len(b1):]
+    return html.fromstring(ht)
+
+
+def bench_removeBlocks(scr,sizes=(10,100,1000)):
+    results=[]
+    for blocks in sizes:
+        h=html.fromstring(synthetic_page(blocks=blocks,paragraphs=max(200,blocks)))
+        same=scr.removeBlocks(h).text_content()==removeBlocks_legacy(h).text_content()
+        legacy=timeit(lambda: removeBlocks_legacy(h))
+        current=timeit(lambda: scr.removeBlocks(h))
+        results.append({'blocks':blocks,'bytes':len(html.tostring(h)),'legacy_s':legacy,'current_s':current,
+                        'speedup':legacy/current if current else None,'same_text':same})
+        print('## removeBlocks',blocks,'blocks - legacy %.4fs / current %.4fs' % (legacy,current),sep=' ')
+    return results
+
+
+## routineFindings  ##              ##
+##                  ##              ##
+def bench_routineFindings(scr,pages=50,paragraphs=200):
+    docs=[html.fromstring(synthetic_page(0,paragraphs,n)) for n in range(pages)]
+    t=timeit(lambda: [scr.routineFindings(d) for d in docs])
+    print('## routineFindings',pages,'pages - %.4fs / %.2fms per page' % (t,1000*t/pages),sep=' ')
+    return {'pages':pages,'paragraphs':paragraphs,'total_s':t,'per_page_ms':1000*t/pages}
+
+
+## db writes        ##              ##
+##                  ##              ##
+def bench_writes(n=2000,storage={}):
+    '''addTask then done for n tasks in a fresh db, with the given storage options.'''
+    name=TASK_NAME+'-writes'
+    for f in glob.glob(name+'-db.sqlite*'):
+        os.remove(f)
+    db=sc.Scrape_Db(name,ver_check=False,storage=storage)
+    content=synthetic_page(2,20)
+    t=time.time()
+    for i in range(n):
+        db.addTask('task'+str(i),ctype='html',content=content,standalone=True)
+    db.flush()
+    added=time.time()-t
+    t=time.time()
+    for i in range(n):
+        db.done('task'+str(i),{'n':i,'title':'page '+str(i)})
+    db.flush()
+    done=time.time()-t
+    db.close()
+    print('\n## writes',n,'tasks',json.dumps(storage),'- addTask %.1f/s / done %.1f/s' % (n/added,n/done),sep=' ')
+    return {'tasks':n,'storage':storage,'addTask_per_s':n/added,'done_per_s':n/done}
+
+
+def bench_addTasks(n=100000):
+    '''addTasks of n url tasks in a fresh db, then the same again (all already tasks).'''
+    name=TASK_NAME+'-bulk'
+    for f in glob.glob(name+'-db.sqlite*'):
+        os.remove(f)
+    db=sc.Scrape_Db(name,ver_check=False)
+    t=time.time()
+    db.addTasks((('https://example.com/page/'+str(i),'url','') for i in range(n)),feedback=False)
+    added=time.time()-t
+    t=time.time()
+    db.addTasks((('https://example.com/page/'+str(i),'url','') for i in range(n)),feedback=False)
+    again=time.time()-t
+    db.close()
+    print('## addTasks',n,'tasks - new %.1f/s / known %.1f/s' % (n/added,n/again),sep=' ')
+    return {'tasks':n,'new_per_s':n/added,'known_per_s':n/again}
+
+
+## to_excel         ##              ##
+##                  ##              ##
+def bench_to_excel(scr):
+    t=time.time()
+    scr.to_excel()
+    t=time.time()-t
+    print('## to_excel %.3fs' % t)
+    return {'rows':scr.cursor.execute('SELECT COUNT(*) FROM scrapedata;').fetchone()[0],'elapsed_s':t}
+
+
+## exportResults    ##              ##
+##                  ##              ##
+def bench_export(scr,formats=('.csv','.parquet','.xlsx')):
+    results=[]
+    for ext in formats:
+        t=time.time()
+        rows=scr.exportResults(TASK_NAME+'-export'+ext,display=NODISPLAY)
+        t=time.time()-t
+        print('## exportResults',ext,rows,'rows %.3fs' % t,sep=' ')
+        results.append({'format':ext,'rows':rows,'elapsed_s':t})
+    return results
+
+
+## startup          ##              ##
+##                  ##              ##
+STARTUP_BUDGET={'import_s':0.1,'construct_s':0.1}
+
+def bench_startup(repeat=5):
+    '''import scrrry and Scrape_Db() (no version check, it's a network call) in fresh interpreters, best of repeat, against STARTUP_BUDGET.'''
+    import subprocess
+    name=TASK_NAME+'-startup'
+    code=('import time;t=time.time();import scrrry as sc;i=time.time()-t;t=time.time();'
+          's=sc.Scrape_Db("'+name+'",ver_check=False);c=time.time()-t;s.close();print(i,c)')
+    best=None
+    for _ in range(repeat):
+        out=subprocess.check_output([sys.executable,'-c',code],cwd=os.getcwd(),
+                                    env=dict(os.environ,PYTHONPATH=os.path.dirname(os.path.abspath(sc.__file__))))
+        i,c=[float(x) for x in out.decode().strip().split('\n')[-1].split()]
+        best=(i,c) if best is None else (min(best[0],i),min(best[1],c))
+    for f in glob.glob(name+'-db.sqlite*'):
+        os.remove(f)
+    r={'import_s':best[0],'construct_s':best[1]}
+    r['within_budget']=all(r[k]<=v for k,v in STARTUP_BUDGET.items())
+    print('## startup - import %.3fs / construct %.3fs' % best,'(within budget)' if r['within_budget'] else '!! over budget',sep=' ')
+    return r
+
+
+## RUN              ##              ##
+if __name__ == '__main__':
+    ap=argparse.ArgumentParser(description='scrrry benchmarks')
+    ap.add_argument('out',nargs='?',default='benchmark-results.json')
+    ap.add_argument('--pages',type=int,default=200,help='number of pages served/gathered')
+    ap.add_argument('--paragraphs',type=int,default=200,help='paragraphs per page (page size)')
+    ap.add_argument('--procs',type=int,default=4,help='processes for the multi scrape')
+    ap.add_argument('--workers',type=int,default=16,help='threads for the concurrent gather')
+    ap.add_argument('--writes',type=int,default=2000,help='tasks for the addTask/done benchmark')
+    ap.add_argument('--bulk',type=int,default=100000,help='tasks for the addTasks benchmark')
+    args=ap.parse_args()
+
+    for f in glob.glob(TASK_NAME+'-db.sqlite*'):
+        os.remove(f)
+    srv,urls=serve(args.pages,args.paragraphs)
+    scr=sc.Scrape_Db(TASK_NAME,ver_check=False)
+    results={'scrrry':sc.VERSION,'python':platform.python_version(),'time':time.strftime('%Y-%m-%d %H:%M:%S'),
+             'config':vars(args)}
+    results['startup']=bench_startup()
+    results['gather']=bench_gather(urls,args.workers)
+    results['scrape']=bench_scrape(args.procs)
+    results['removeBlocks']=bench_removeBlocks(scr)
+    results['routineFindings']=bench_routineFindings(scr,paragraphs=args.paragraphs)
+    results['writes']=[bench_writes(args.writes),bench_writes(args.writes,{'wal':True,'commitevery':500,'commitinterval':5})]
+    results['addTasks']=bench_addTasks(args.bulk)
+    results['to_excel']=bench_to_excel(scr)
+    results['exportResults']=bench_export(scr)
+    scr.close()
+    srv.shutdown()
+
+    with open(args.out,'w') as f:
+        json.dump(results,f,indent=1)
+    print('## ... Results written >',args.out,sep=' ')
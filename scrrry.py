@@ -11,25 +11,213 @@ VERSION='0.2.4'
 #   MIT License, Copyright (c) 2017 David Galbicsek
 #
 
-from lxml import html
-
+import collections
+import copy
 import datetime
+import hashlib
+import hmac
+import itertools
 import json
 import math
-import pandas as pd
+import os
+import random
 import re
-import requests
+import socket
 import sqlite3
+import sys
+import threading
 import time
+import zlib
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+
+def _lazy(name):
+    """Module name, actually loaded on first use (so pool workers and quick scripts
+    don't pay for lxml/requests until they need them), a plain import where importlib can't defer it."""
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        import importlib.util
+        spec=importlib.util.find_spec(name)
+        loader=importlib.util.LazyLoader(spec.loader)
+    except (ImportError,AttributeError):
+        import importlib
+        return importlib.import_module(name)
+    spec.loader=loader
+    module=importlib.util.module_from_spec(spec)
+    sys.modules[name]=module
+    loader.exec_module(module)
+    if '.' in name:
+        # as an import would, so that 'import lxml.html; lxml.html...' works in user code
+        parent,child=name.rsplit('.',1)
+        setattr(sys.modules[parent],child,module)
+    return module
+
+etree=_lazy('lxml.etree')
+html=_lazy('lxml.html')
+requests=_lazy('requests')
 
 RE_EMAIL = r'''([a-zA-Z0-9\._%+-]+@[a-zA-Z0-9\.-]+(?:\.[a-zA-Z]{2,4})+)'''
 RE_PHONE = r'''([0-9\._+()-][0-9\._+() -]{5,}[0-9\._+()-])'''
+CONTACT_PATTERNS = [('email',RE_EMAIL),('phone',RE_PHONE)]
+_CONTACT_MATCHERS = {}
 
 SURVEY_KEYWORDS = ['email-protection', 'ld+json', 'schema.org']
 
+# compressed values are stored as blobs: marker + method (z=zlib, s=zstd) + type of the original (s=str, b=bytes) + data
+COMPRESS_MARK = b'\x00scrrry'
+
+# defaults for Scrape_Db.http, used when the shared session is set up by the first fetch()
+HTTP_DEFAULTS = {'retries':3,'backoff':0.5,'poolsize':10,'timeout':20,'headers':{}}
+RETRY_STATUSES = (429,500,502,503,504)
+
+# the version check runs in the background, at most once a day per task db (ttl seconds)
+VERSION_URL = 'https://raw.githubusercontent.com/DGalbichek/scrrry/master/scrrry.py'
+VERSION_CHECK = {'timeout':3,'ttl':86400}
+
+# columns added to scrapedata after its original layout
+SCRAPEDATA_COLUMNS = [('http_etag','TEXT'),('http_lastmodified','TEXT'),
+                      ('raw_hash','TEXT'),('scrape_raw_hash','TEXT'),('scrape_version','TEXT')]
+
+
+def _rawHash(val):
+    """Hash of a task's (uncompressed) raw content, to tell whether a page changed between gathers."""
+    if val is None:
+        return None
+    if not isinstance(val,bytes):
+        val=(val if isinstance(val,str) else str(val)).encode('utf-8')
+    return hashlib.sha1(val).hexdigest()
+
+
+def _pack(val,method):
+    """Compresses a str/bytes value for storage with method ('zlib' or 'zstd'), anything else is left alone."""
+    if not method or not isinstance(val,(str,bytes)) or val[:len(COMPRESS_MARK)]==COMPRESS_MARK:
+        return val
+    kind=b's' if isinstance(val,str) else b'b'
+    data=val.encode('utf-8') if kind==b's' else val
+    if method=='zstd':
+        import zstandard
+        return sqlite3.Binary(COMPRESS_MARK+b's'+kind+zstandard.ZstdCompressor().compress(data))
+    return sqlite3.Binary(COMPRESS_MARK+b'z'+kind+zlib.compress(data))
 
-def algofunctMultiWrapper(tup):
-    return [tup[0](tup[1][x]) for x in range(tup[2][0],tup[2][1])]
+
+def _unpack(val):
+    """Reverses _pack, values without the marker are returned as they are."""
+    if not isinstance(val,bytes) or not val.startswith(COMPRESS_MARK):
+        return val
+    method,kind,data=val[len(COMPRESS_MARK):len(COMPRESS_MARK)+1],val[len(COMPRESS_MARK)+1:len(COMPRESS_MARK)+2],val[len(COMPRESS_MARK)+2:]
+    if method==b's':
+        import zstandard
+        data=zstandard.ZstdDecompressor().decompress(data)
+    else:
+        data=zlib.decompress(data)
+    return data.decode('utf-8') if kind==b's' else data
+
+
+_MULTI_ALGOFUNCT=None
+_MULTI_DBPATH=None
+# (task db path, uid) -> (scrape_task_type, scrape_task_content) handed over with the task, read before the db
+_PREFETCHED={}
+
+
+def _multiInit(algofunct,dbpath):
+    # pool initializer, so the scrape function isn't pickled with every task
+    global _MULTI_ALGOFUNCT,_MULTI_DBPATH
+    _MULTI_ALGOFUNCT=algofunct
+    _MULTI_DBPATH=dbpath
+
+
+def _multiScrape(task):
+    it,dtype,raw=task
+    _PREFETCHED[(_MULTI_DBPATH,it)]=(dtype,raw)
+    try:
+        return (it,)+_timedCall(_MULTI_ALGOFUNCT,it)
+    finally:
+        del _PREFETCHED[(_MULTI_DBPATH,it)]
+
+
+def _timedCall(funct,it):
+    t=time.time()
+    r=funct(it)
+    return r,time.time()-t
+
+
+def _host(it):
+    return urlparse(str(it)).netloc
+
+
+class _DeferredTask():
+    """An addTask call made from a concurrent gather worker (or in a queue cycle), carried back to the cycle's writer."""
+    def __init__(self,uid,ctype,content,testing,update):
+        self.uid=uid
+        self.ctype=ctype
+        self.content=content
+        self.testing=testing
+        self.update=update
+
+
+class _DeferredPrompt():
+    """A tc_done/tc_wasdone/tc_skipped/tc_nodata call made from a concurrent gather worker, counted by the writer."""
+    def __init__(self,kind,args):
+        self.kind=kind
+        self.args=args
+
+
+def contactMatcher(kind):
+    """Compiled pattern of a contact kind ('email' or 'phone'), cached."""
+    if kind not in _CONTACT_MATCHERS:
+        _CONTACT_MATCHERS[kind]=re.compile(dict(CONTACT_PATTERNS)[kind])
+    return _CONTACT_MATCHERS[kind]
+
+
+def findContacts(text,what=('email','phone')):
+    """Emails/phone numbers in text, one pass per kind (so matches of one kind don't cut into the other's),
+    as an ordered dict of (kind, value) -> [positions], values stripped of surrounding '.- ', by kind and first appearance.
+    """
+    found=collections.OrderedDict()
+    for kind,_ in CONTACT_PATTERNS:
+        if kind not in what:
+            continue
+        for m in contactMatcher(kind).finditer(text):
+            raw=m.group(1)
+            value=raw.strip('.- ')
+            found.setdefault((kind,value),[]).append(m.start(1)+len(raw)-len(raw.lstrip('.- ')))
+    return found
+
+
+def robotsCrawlDelay(text,agent='*'):
+    """Crawl-delay in a robots.txt for agent (a group naming a part of it, or else *), 0 if none.
+    (urllib's robotparser only takes whole seconds.)
+    """
+    delays={}
+    agents,ingroup=[],False
+    for line in text.splitlines():
+        line=line.split('#')[0].strip()
+        if ':' not in line:
+            continue
+        k,v=[x.strip() for x in line.split(':',1)]
+        k=k.lower()
+        if k=='user-agent':
+            if ingroup:
+                agents,ingroup=[],False
+            agents.append(v.lower())
+        else:
+            ingroup=True
+            if k=='crawl-delay':
+                try:
+                    for a in agents:
+                        delays.setdefault(a,float(v))
+                except ValueError:
+                    pass
+    agent=agent.lower()
+    for a,d in delays.items():
+        if a!='*' and a in agent:
+            return d
+    return delays.get('*',0)
 
 
 def survey_page(pagetext):
@@ -46,9 +234,1013 @@ def decode_email(ee):
     except (ValueError):
         return ''
 
-		
+
+
+##
+##  SINKS
+##
+class _Sink():
+    """Writes rows (dicts) to a file as they come. Columns default to the keys of the first row,
+    keys not among them are dropped, lists/dicts are stored as json.
+    """
+    def __init__(self,filename,columns=None):
+        self.filename=filename
+        self.columns=list(columns) if columns else None
+        self.rows=0
+
+    def _values(self,row):
+        if self.columns is None:
+            self.columns=list(row.keys())
+            self._start()
+        return [json.dumps(row[c]) if isinstance(row.get(c),(list,dict)) else row.get(c) for c in self.columns]
+
+    def _start(self):
+        pass
+
+    def write(self,row):
+        self.rows+=1
+
+    def writeRows(self,rows):
+        """Writes rows given as lists of values in the order of self.columns."""
+        for r in rows:
+            self.write(dict(zip(self.columns,r)))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+
+class CsvSink(_Sink):
+    def __init__(self,filename,columns=None):
+        import csv
+        _Sink.__init__(self,filename,columns)
+        self.f=open(filename,'w',newline='',encoding='utf-8')
+        self.writer=csv.writer(self.f)
+        if self.columns:
+            self._start()
+
+    def _start(self):
+        self.writer.writerow(self.columns)
+
+    def write(self,row):
+        self.writer.writerow(self._values(row))
+        _Sink.write(self,row)
+
+    def writeRows(self,rows):
+        self.writer.writerows(rows)
+        self.rows+=len(rows)
+
+    def close(self):
+        self.f.close()
+
+
+class JsonLinesSink(_Sink):
+    """Keeps rows whole unless columns are given.
+    """
+    nested=True # wants lists/dicts as they are, not as json text
+    def __init__(self,filename,columns=None):
+        _Sink.__init__(self,filename,columns)
+        self.f=open(filename,'w',encoding='utf-8')
+
+    def write(self,row):
+        if self.columns:
+            row={c:row.get(c) for c in self.columns}
+        self.f.write(json.dumps(row)+'\n')
+        _Sink.write(self,row)
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetSink(_Sink):
+    """Buffers rowgroup rows at a time into a parquet row group (needs pyarrow), every column stored as string.
+    """
+    def __init__(self,filename,columns=None,rowgroup=10000):
+        import pyarrow
+        import pyarrow.parquet
+        _Sink.__init__(self,filename,columns)
+        self.pa=pyarrow
+        self.rowgroup=rowgroup
+        self.buffer=[]
+        self.writer=None
+
+    def write(self,row):
+        self.buffer.append([None if v is None else str(v) for v in self._values(row)])
+        _Sink.write(self,row)
+        if len(self.buffer)>=self.rowgroup:
+            self._writegroup()
+
+    def writeRows(self,rows):
+        self.buffer.extend([None if v is None else str(v) for v in r] for r in rows)
+        self.rows+=len(rows)
+        if len(self.buffer)>=self.rowgroup:
+            self._writegroup()
+
+    def _writegroup(self):
+        if self.writer is None:
+            schema=self.pa.schema([(c,self.pa.string()) for c in self.columns])
+            self.writer=self.pa.parquet.ParquetWriter(self.filename,schema)
+        cols=list(zip(*self.buffer))
+        self.writer.write_table(self.pa.table([self.pa.array(c,self.pa.string()) for c in cols],names=self.columns))
+        self.buffer=[]
+
+    def close(self):
+        if self.buffer:
+            self._writegroup()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def _cell(v):
+    # a value as SQLite's json_extract gives it: nested values as compact json, booleans as 0/1
+    if isinstance(v,(list,dict)):
+        return json.dumps(v,separators=(',',':'))
+    if isinstance(v,bool):
+        return int(v)
+    return v
+
+
+class ExcelSink(_Sink):
+    """Streams rows into an xlsx with xlsxwriter's constant_memory mode, a new sheet is started at Excel's row limit.
+    """
+    MAXROWS=1048575
+
+    def __init__(self,filename,columns=None,sheet='data'):
+        import xlsxwriter
+        _Sink.__init__(self,filename,columns)
+        self.workbook=xlsxwriter.Workbook(filename,{'constant_memory':True,'strings_to_urls':False})
+        self.sheet=sheet
+        self.sheets=0
+        self.worksheet=None
+        if self.columns:
+            self._start()
+
+    def _start(self):
+        self.sheets+=1
+        self.worksheet=self.workbook.add_worksheet(self.sheet if self.sheets==1 else self.sheet+str(self.sheets))
+        self.worksheet.write_row(0,0,self.columns)
+        self.sheetrow=0
+
+    def write(self,row):
+        self.writeRows([self._values(row)])
+
+    def writeRows(self,rows):
+        for values in rows:
+            if self.sheetrow==self.MAXROWS:
+                self._start()
+            self.sheetrow+=1
+            self.worksheet.write_row(self.sheetrow,0,values)
+        self.rows+=len(rows)
+
+    def close(self):
+        self.workbook.close()
+
+
+SINKS = {'.csv':CsvSink,'.jsonl':JsonLinesSink,'.parquet':ParquetSink,'.xlsx':ExcelSink}
+
+
+def openSink(filename,columns=None):
+    """Sink for filename, picked by its extension (see SINKS)."""
+    ext=os.path.splitext(filename)[1].lower()
+    if ext not in SINKS:
+        raise ValueError('no sink for '+ext+' files, use one of '+', '.join(SINKS))
+    return SINKS[ext](filename,columns)
+
+
+
+##
+##  PROXIES
+##
+class ProxyPool():
+    """Proxies ('ip:port') scored by success rate and latency. pick() hands out one of the fastest healthy ones,
+    a failed proxy goes on a cooldown that doubles with every failure in a row (up to maxcooldown) instead of being dropped.
+    """
+    def __init__(self,testurl='https://httpbin.org/ip',timeout=10,cooldown=60,maxcooldown=3600,workers=20):
+        self.testurl=testurl
+        self.timeout=timeout
+        self.cooldown=cooldown
+        self.maxcooldown=maxcooldown
+        self.workers=workers
+        self.proxies={}
+        self.lock=threading.Lock()
+
+    def add(self,proxies):
+        """Adds 'ip:port' strings or {'ip':..,'port':..} dicts, returns the ones that are new."""
+        new=[]
+        with self.lock:
+            for p in proxies:
+                addr=p['ip']+':'+p['port'] if isinstance(p,dict) else p.strip()
+                if addr and addr not in self.proxies:
+                    self.proxies[addr]={'ok':0,'fail':0,'streak':0,'latency':None,'until':0}
+                    new.append(addr)
+        return new
+
+    def loadFile(self,path):
+        """Adds proxies from a file with one ip:port per line (# for comments)."""
+        with open(path) as f:
+            return self.add([x.split('#')[0] for x in f if x.split('#')[0].strip()])
+
+    def report(self,addr,ok,latency=None):
+        with self.lock:
+            p=self.proxies.get(addr)
+            if p is None:
+                return
+            if ok:
+                p['ok']+=1
+                p['streak']=0
+                p['until']=0
+                if latency is not None:
+                    p['latency']=latency if p['latency'] is None else p['latency']*0.7+latency*0.3
+            else:
+                p['fail']+=1
+                p['streak']+=1
+                p['until']=time.time()+min(self.cooldown*2**(p['streak']-1),self.maxcooldown)
+
+    def healthy(self):
+        """Proxies out of cooldown, best first (success rate, then latency, untested ones after tested ones)."""
+        now=time.time()
+        with self.lock:
+            av=[(a,p) for a,p in self.proxies.items() if p['until']<=now]
+        return [a for a,p in sorted(av,key=lambda x:(-(x[1]['ok']+1.)/(x[1]['ok']+x[1]['fail']+2),
+                                                         x[1]['latency'] if x[1]['latency'] is not None else self.timeout))]
+
+    def pick(self,top=3):
+        """One of the top few healthy proxies, None if all are cooling down."""
+        h=self.healthy()[:top]
+        return random.choice(h) if h else None
+
+    def validate(self,addrs=None,fetch=None):
+        """Checks proxies (all by default) concurrently against testurl and scores them, returns the working ones."""
+        from concurrent.futures import ThreadPoolExecutor
+        addrs=list(self.proxies) if addrs is None else addrs
+        fetch=fetch or (lambda url,proxies: requests.get(url,proxies=proxies,timeout=self.timeout))
+
+        def check(addr):
+            t=time.time()
+            try:
+                ok=fetch(self.testurl,{'http':'http://'+addr,'https':'http://'+addr}).status_code==200
+            except Exception:
+                ok=False
+            self.report(addr,ok,time.time()-t)
+            return addr,ok
+
+        if not addrs:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.workers,len(addrs))) as pool:
+            return [a for a,ok in pool.map(check,addrs) if ok]
+
+    def state(self):
+        with self.lock:
+            return {a:dict(p) for a,p in self.proxies.items()}
+
+    def load(self,state):
+        with self.lock:
+            self.proxies.update({a:dict(p) for a,p in state.items()})
+
+
+
+##
+##  SCHEDULING
+##
+class HostScheduler():
+    """Hands out gather tasks round robin across hosts, keeping to a per host concurrency
+    and request rate (rate: requests/s, robots.txt crawl-delay sets a floor when given).
+    adaptive: a 429/503 doubles the host's delay and halves its concurrency, a host answering
+    much slower than it used to loses a slot, both recover step by step with healthy responses.
+    """
+    THROTTLE=(429,503)
+
+    def __init__(self,perhost=4,rate=None,adaptive=True,maxdelay=60,robots=False):
+        self.perhost=perhost
+        self.rate=rate
+        self.adaptive=adaptive
+        self.maxdelay=maxdelay
+        self.robots=robots
+        self.hosts={}
+        self.turn=collections.deque() # hosts with queued tasks, in round robin order
+        self.queued=0
+        self.due=None
+        self.lock=threading.Lock()
+
+    def _host(self,h):
+        s=self.hosts.get(h)
+        if s is None:
+            base=1./self.rate if self.rate else 0.
+            s=self.hosts[h]={'queue':collections.deque(),'inflight':0,'limit':self.perhost,'base':base,'delay':base,
+                             'next':0.,'latency':None,'ok':0,'requests':0,'throttled':0,'crawldelay':None,
+                             'ready':not self.robots}
+        return s
+
+    def add(self,i,it,h):
+        with self.lock:
+            s=self._host(h)
+            if 'scheme' not in s:
+                s['scheme']=urlparse(str(it)).scheme or 'http'
+            if not s['queue']:
+                self.turn.append(h)
+            s['queue'].append((i,it))
+            self.queued+=1
+
+    def __len__(self):
+        return self.queued
+
+    def waitingRobots(self):
+        """(host, scheme) to look up robots.txt for before the host's first request (each returned once)."""
+        with self.lock:
+            r=[(h,s['scheme']) for h,s in self.hosts.items() if not s['ready'] and s['crawldelay'] is None]
+            for h,_ in r:
+                self.hosts[h]['crawldelay']=-1
+            return r
+
+    def setCrawlDelay(self,h,delay):
+        with self.lock:
+            s=self._host(h)
+            s['ready']=True
+            s['crawldelay']=delay or 0
+            if delay:
+                s['base']=max(s['base'],delay)
+                s['delay']=max(s['delay'],s['base'])
+
+    def next(self,now=None):
+        """(i, task, host) to start now, or None, with self.due set to the seconds until a host is due
+        (None if all are waiting for a request to finish)."""
+        with self.lock:
+            now=now or time.time()
+            wait=None
+            for _ in range(len(self.turn)):
+                h=self.turn[0]
+                self.turn.rotate(-1)
+                s=self.hosts[h]
+                if not s['ready'] or s['inflight']>=s['limit']:
+                    continue
+                if s['next']>now:
+                    wait=min(wait,s['next']-now) if wait is not None else s['next']-now
+                    continue
+                i,it=s['queue'].popleft()
+                if not s['queue']:
+                    self.turn.remove(h)
+                self.queued-=1
+                s['inflight']+=1
+                s['requests']+=1
+                s['next']=now+s['delay']
+                return i,it,h
+            self.due=wait
+
+    def finished(self,h,seconds):
+        with self.lock:
+            s=self.hosts[h]
+            s['inflight']-=1
+            if not self.adaptive:
+                return
+            if s['latency'] is not None and seconds>max(1.,3*s['latency']):
+                s['limit']=max(1,s['limit']-1)
+                s['ok']=0
+            else:
+                s['ok']+=1
+                s['delay']=max(s['base'],s['delay']*.85)
+                if s['ok']>=5:
+                    s['ok']=0
+                    s['limit']=min(self.perhost,s['limit']+1)
+            s['latency']=seconds if s['latency'] is None else .8*s['latency']+.2*min(seconds,10*s['latency'])
+
+    def observe(self,h,status,retryafter=None):
+        """Response status seen for host h (called by fetch, from any thread)."""
+        if status not in self.THROTTLE:
+            return
+        with self.lock:
+            s=self._host(h)
+            s['throttled']+=1
+            if self.adaptive:
+                s['limit']=max(1,s['limit']//2)
+                s['ok']=0
+                s['delay']=min(self.maxdelay,max(s['base'],s['delay']*2,retryafter or 0,1.))
+                s['next']=max(s['next'],time.time()+s['delay'])
+
+    def stats(self):
+        return {h:{'requests':s['requests'],'throttled':s['throttled'],'delay':s['delay'],'limit':s['limit'],
+                   'crawldelay':s['crawldelay'] if s['ready'] else None} for h,s in self.hosts.items()}
+
+
+
+##
+##  BROWSERS
+##
+class DriverPool():
+    """Warm selenium drivers shared by (concurrent) tasks: checked out with 'with pool.driver() as d:',
+    started by factory() as needed up to size, quit and replaced after maxpages checkouts
+    or when a task fails while holding one.
+    """
+    def __init__(self,factory,size=2,maxpages=50):
+        self.factory=factory
+        self.size=size
+        self.maxpages=maxpages
+        self.idle=[] # last returned first
+        self.started=0
+        self.recycled=0
+        self.uses={}
+        self.lock=threading.Condition()
+
+    def get(self,timeout=None):
+        """An idle driver, a new one if the pool isn't full (anymore), otherwise waits for either;
+        raises queue.Empty after timeout seconds."""
+        end=None if timeout is None else time.time()+timeout
+        with self.lock:
+            while not self.idle and self.started>=self.size:
+                left=None if end is None else end-time.time()
+                if left is not None and left<=0:
+                    try:
+                        import queue
+                    except ImportError:
+                        import Queue as queue
+                    raise queue.Empty()
+                self.lock.wait(left)
+            if self.idle:
+                return self.idle.pop()
+            self.started+=1
+        try:
+            d=self.factory()
+        except Exception:
+            with self.lock:
+                self.started-=1
+                self.lock.notify()
+            raise
+        self.uses[id(d)]=0
+        return d
+
+    def put(self,d,broken=False):
+        """Returns d to the pool, quitting it if it's broken or has done maxpages
+        (a task waiting for a driver then starts a new one)."""
+        self.uses[id(d)]=self.uses.get(id(d),0)+1
+        if broken or (self.maxpages and self.uses[id(d)]>=self.maxpages):
+            self._quit(d)
+            with self.lock:
+                self.started-=1
+                self.recycled+=1
+                self.lock.notify()
+        else:
+            with self.lock:
+                self.idle.append(d)
+                self.lock.notify()
+
+    def driver(self,timeout=None):
+        pool=self
+        class _Checkout():
+            def __enter__(self):
+                self.d=pool.get(timeout)
+                return self.d
+            def __exit__(self,exc,*args):
+                pool.put(self.d,broken=exc is not None)
+        return _Checkout()
+
+    def _quit(self,d):
+        self.uses.pop(id(d),None)
+        try:
+            d.quit()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.lock:
+            idle,self.idle=self.idle,[]
+            self.started=0
+            self.lock.notify_all()
+        for d in idle:
+            self._quit(d)
+
+    def stats(self):
+        return {'started':self.started,'idle':len(self.idle),'recycled':self.recycled}
+
+
+
+##
+##  METRICS
+##
+class CycleMetrics():
+    """Timing and throughput of one task cycle: task durations (histogram, per host for gathering),
+    tasks/s, bytes fetched and stored, time in db calls and in the task callback.
+    db time spent inside the callback (e.g. addTask in gatherTask) counts towards both.
+    """
+    BUCKETS=(0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60)
+
+    def __init__(self,cycle,session=''):
+        self.cycle=cycle
+        self.session=session
+        self.started=time.time()
+        self.ended=None
+        self.elements=0
+        self.tasks=0
+        self.hist=[0]*(len(self.BUCKETS)+1)
+        self.callback=0.
+        self.db=0.
+        self.bytesin=0
+        self.bytesout=0
+        self.hosts={}
+        self.hoststats=None
+        self.pages=0
+        self.pagetime=0.
+        self._lastpages=(0,0.)
+        self.lock=threading.Lock()
+
+    def task(self,seconds,host=None):
+        self.tasks+=1
+        self.callback+=seconds
+        for n,b in enumerate(self.BUCKETS):
+            if seconds<=b:
+                self.hist[n]+=1
+                break
+        else:
+            self.hist[-1]+=1
+        if host:
+            h=self.hosts.setdefault(host,[0,0.])
+            h[0]+=1
+            h[1]+=seconds
+
+    def page(self,seconds):
+        """A browser page load (render) took seconds, from any thread."""
+        with self.lock:
+            self.pages+=1
+            self.pagetime+=seconds
+
+    def pageLatency(self):
+        """' 1.23s/page': average page load since the last call, '' if no pages were loaded."""
+        with self.lock:
+            p,t=self.pages-self._lastpages[0],self.pagetime-self._lastpages[1]
+            self._lastpages=(self.pages,self.pagetime)
+        return ' %.2fs/page' % (t/p) if p else ''
+
+    def add(self,what,amount):
+        """Thread safe increment of db, bytesin or bytesout."""
+        with self.lock:
+            setattr(self,what,getattr(self,what)+amount)
+
+    def quantile(self,q):
+        """Upper bucket bound the q-th quantile of task durations falls in."""
+        if not self.tasks:
+            return None
+        c=0
+        for n,x in enumerate(self.hist):
+            c+=x
+            if c>=q*self.tasks:
+                return self.BUCKETS[n] if n<len(self.BUCKETS) else float('inf')
+
+    def elapsed(self):
+        return (self.ended or time.time())-self.started
+
+    def summary(self):
+        el=self.elapsed()
+        return {'cycle':self.cycle,'session':self.session,'started':self.started,'elapsed':el,
+                'elements':self.elements,'tasks':self.tasks,'elements_per_s':self.elements/el if el else None,
+                'task_p50':self.quantile(.5),'task_p95':self.quantile(.95),
+                'histogram':dict(zip([str(b) for b in self.BUCKETS]+['+Inf'],self.hist)),
+                'callback_s':self.callback,'db_s':self.db,'bytes_in':self.bytesin,'bytes_out':self.bytesout,
+                'hosts':{h:{'tasks':v[0],'seconds':v[1]} for h,v in self.hosts.items()},'scheduler':self.hoststats,
+                'pages':self.pages,'page_s':self.pagetime}
+
+    def slowHosts(self,top=5):
+        """Hosts with the highest average task time."""
+        return sorted(((h,v[1]/v[0]) for h,v in self.hosts.items()),key=lambda x:-x[1])[:top]
+
+    def json(self):
+        return json.dumps(self.summary())
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format."""
+        lb='cycle="'+self.cycle+'"'
+        r=['# TYPE scrrry_task_seconds histogram']
+        c=0
+        for b,x in zip([str(b) for b in self.BUCKETS]+['+Inf'],self.hist):
+            c+=x
+            r.append('scrrry_task_seconds_bucket{'+lb+',le="'+b+'"} '+str(c))
+        r.append('scrrry_task_seconds_sum{'+lb+'} '+repr(self.callback))
+        r.append('scrrry_task_seconds_count{'+lb+'} '+str(self.tasks))
+        for name,typ,val in [('elements_total','counter',self.elements),('elements_per_second','gauge',self.summary()['elements_per_s'] or 0),
+                             ('db_seconds_total','counter',self.db),('callback_seconds_total','counter',self.callback),
+                             ('bytes_in_total','counter',self.bytesin),('bytes_out_total','counter',self.bytesout)]:
+            r.append('# TYPE scrrry_'+name+' '+typ)
+            r.append('scrrry_'+name+'{'+lb+'} '+repr(val))
+        if self.hosts:
+            r.append('# TYPE scrrry_host_task_seconds_total counter')
+            for h,v in self.hosts.items():
+                r.append('scrrry_host_task_seconds_total{'+lb+',host="'+h+'"} '+repr(v[1]))
+        if self.hoststats:
+            r.append('# TYPE scrrry_host_throttled_total counter')
+            for h,v in self.hoststats.items():
+                r.append('scrrry_host_throttled_total{'+lb+',host="'+h+'"} '+str(v['throttled']))
+        return '\n'.join(r)+'\n'
+
+
+
+##
+##  PARSE CACHE
+##
+class ParseCache():
+    """LRU cache of what's derived from task pages (text, ld+json, findings), keyed by task uid and hash
+    of the raw content, so a changed page is worked out again. Trees aren't kept: copying one costs about
+    as much as parsing the page again. Off (maxitems=0) until switched on, e.g. PARSE_CACHE.resize(maxitems=512),
+    for scrapes that go over the same pages more than once; a pool worker has a cache of its own.
+    Size is an estimate, the length of each artifact's repr.
+    """
+    def __init__(self,maxbytes=64*1024*1024,maxitems=0):
+        self.maxbytes=maxbytes
+        self.maxitems=maxitems
+        self.entries=collections.OrderedDict()
+        self.bytes=0
+        self.hits,self.misses,self.evictions=0,0,0
+        self.lock=threading.RLock()
+
+    def get(self,key,what,build,size):
+        """Artifact what of entry key, made by build() if not cached yet (size(artifact) estimates its memory)."""
+        if not self.maxitems:
+            self.misses+=1
+            return build()
+        with self.lock:
+            entry=self.entries.get(key)
+            if entry is not None and what in entry:
+                self.entries.move_to_end(key)
+                self.hits+=1
+                return entry[what][0]
+        val=build()
+        sz=size(val)
+        with self.lock:
+            self.misses+=1
+            entry=self.entries.setdefault(key,{})
+            self.entries.move_to_end(key)
+            if what in entry:
+                self.bytes-=entry[what][1]
+            entry[what]=(val,sz)
+            self.bytes+=sz
+            self._evict()
+        return val
+
+    def _evict(self):
+        while len(self.entries)>1 and (len(self.entries)>self.maxitems or self.bytes>self.maxbytes):
+            _,entry=self.entries.popitem(last=False)
+            self.bytes-=sum(x[1] for x in entry.values())
+            self.evictions+=1
+
+    def resize(self,maxbytes=None,maxitems=None):
+        """Changes the limits, maxitems=0 turns caching off."""
+        with self.lock:
+            if maxbytes is not None:
+                self.maxbytes=maxbytes
+            if maxitems is not None:
+                self.maxitems=maxitems
+            if not self.maxitems:
+                self.clear()
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes=0
+
+    def stats(self):
+        looks=self.hits+self.misses
+        return {'items':len(self.entries),'bytes':self.bytes,'hits':self.hits,'misses':self.misses,
+                'evictions':self.evictions,'hitrate':float(self.hits)/looks if looks else None}
+
+
+PARSE_CACHE=ParseCache()
+
+
+
+##
+##  SELECTION
+##
+TASK_STATES = ('all','pending','done','skipped')
+
+
+class TaskSelection():
+    """uids of the tasks matching a Scrape_Db.selectTasks query, read from the db in pages (keyset on id)
+    as they're iterated, in the order tasks were added. len() is a COUNT, so it's known before any are read.
+    Tasks added after the selection was made are left out.
+    """
+    def __init__(self,scr,where='1',params=(),limit=None,sample=None,after=0,pagesize=1000):
+        self.scr=scr
+        self.where=where
+        self.params=list(params)
+        self.limit=limit
+        self.after=after
+        self.pagesize=pagesize
+        self.maxid=scr._readCursor().execute('''SELECT COALESCE(MAX(id),0) FROM scrapedata;''').fetchone()[0]
+        self.ids=None
+        if sample is not None:
+            self.ids=sorted(x[0] for x in scr._readCursor().execute('''SELECT id FROM scrapedata WHERE id>? AND id<=? AND ('''+where+''')
+                                                                       ORDER BY RANDOM() LIMIT ?;''',[after,self.maxid]+self.params+[sample]))
+            if limit is not None:
+                self.ids=self.ids[:limit]
+        self._len=None
+
+    def __len__(self):
+        if self._len is None:
+            if self.ids is not None:
+                self._len=len(self.ids)
+            else:
+                self._len=self.scr._readCursor().execute('''SELECT COUNT(*) FROM scrapedata WHERE id>? AND id<=? AND ('''+self.where+''');''',
+                                                         [self.after,self.maxid]+self.params).fetchone()[0]
+                if self.limit is not None:
+                    self._len=min(self._len,self.limit)
+        return self._len
+
+    def page(self,after=None,size=None):
+        """(uids, id to pass as after for the next page) of the page following task id after, (uids, None) for the last one."""
+        after=self.after if after is None else after
+        size=size or self.pagesize
+        t0=time.time()
+        if self.ids is not None:
+            ids=[i for i in self.ids if i>after][:size]
+            rows=self.scr._readCursor().execute('''SELECT id,scrape_task_uid FROM scrapedata WHERE id IN ('''+','.join('?'*len(ids))+''')
+                                                   ORDER BY id;''',ids).fetchall() if ids else []
+        else:
+            rows=self.scr._readCursor().execute('''SELECT id,scrape_task_uid FROM scrapedata WHERE id>? AND id<=? AND ('''+self.where+''')
+                                                   ORDER BY id LIMIT ?;''',[after,self.maxid]+self.params+[size]).fetchall()
+        self.scr._dbTime(t0)
+        return [x[1] for x in rows],(rows[-1][0] if len(rows)==size else None)
+
+    def __iter__(self):
+        after,left=self.after,self.limit
+        while after is not None and left!=0:
+            uids,after=self.page(after,self.pagesize if left is None else min(self.pagesize,left))
+            for uid in uids:
+                yield uid
+            if left is not None:
+                left-=len(uids)
+
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return list(itertools.islice(self,i.start,i.stop,i.step))
+        for uid in itertools.islice(self,i,None):
+            return uid
+        raise IndexError(i)
+
+
+
+##
+##  QUEUE
+##
+QUEUE_STATES = ('pending','leased','done','failed')
+
+
+def _wire(val):
+    # json-safe copy of val for the http queue, bytes as {'b64':...}
+    if isinstance(val,bytes):
+        import base64
+        return {'b64':base64.b64encode(val).decode('ascii')}
+    if isinstance(val,dict):
+        return {k:_wire(v) for k,v in val.items()}
+    if isinstance(val,(list,tuple)):
+        return [_wire(v) for v in val]
+    return val
+
+
+def _unwire(val):
+    if isinstance(val,dict):
+        if list(val)==['b64']:
+            import base64
+            return base64.b64decode(val['b64'])
+        return {k:_unwire(v) for k,v in val.items()}
+    if isinstance(val,list):
+        return [_unwire(v) for v in val]
+    return val
+
+
+class SqliteQueue():
+    """Lease-based task queue kept next to scrapedata in a task db, shared by the worker processes of one host
+    (see Scrape_Db.taskQueue and queueCycle). Workers claim batches of pending items, which are theirs until
+    the lease runs out unless renewed by heartbeat(); lapsed items go back to pending, and are failed once
+    claimed maxattempts times. complete() merges results into scrapedata, only from the worker holding the lease.
+    """
+    def __init__(self,dbpath,compress=None,maxattempts=5,timeout=30):
+        self.compress=compress
+        self.maxattempts=maxattempts
+        self.lock=threading.Lock()
+        self.db=sqlite3.connect(dbpath,timeout=timeout,check_same_thread=False,isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL;')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS taskqueue( id INTEGER PRIMARY KEY, queue TEXT, item TEXT,
+                           state INTEGER, worker TEXT, lease REAL, attempts INTEGER, UNIQUE(queue,item));''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS taskqueue_state ON taskqueue(queue,state);''')
+        if not [x for x in self.db.execute('PRAGMA index_list(scrapedata);').fetchall()
+                if [c[2] for c in self.db.execute('PRAGMA index_info('+x[1]+');')]==['scrape_task_uid']]:
+            self.db.execute('''CREATE INDEX IF NOT EXISTS scrapedata_task_uid ON scrapedata(scrape_task_uid);''')
+
+    def _transaction(self,funct,*args):
+        # funct(cursor,*args) in one write transaction, taken up front so claims can't interleave
+        with self.lock:
+            cur=self.db.cursor()
+            cur.execute('BEGIN IMMEDIATE;')
+            try:
+                r=funct(cur,*args)
+            except Exception:
+                cur.execute('ROLLBACK;')
+                raise
+            cur.execute('COMMIT;')
+            return r
+
+    def put(self,queue,items,reset=(3,)):
+        """Adds items to queue, items already in it go back to pending if their state is in reset. Returns how many were (re)queued."""
+        def put(cur):
+            cur.executemany('''INSERT INTO taskqueue(queue,item,state,attempts) VALUES (?,?,0,0)
+                               ON CONFLICT(queue,item) DO UPDATE SET state=0,attempts=0,worker=NULL,lease=NULL
+                               WHERE state IN ('''+(','.join(str(int(s)) for s in reset) or 'NULL')+''');''',
+                            ((queue,it) for it in items))
+            return cur.rowcount
+        return self._transaction(put)
+
+    def claim(self,queue,worker,n=20,lease=120,raw=False):
+        """Leases up to n pending items to worker for lease seconds, lapsed leases are taken back first.
+        Returns [item, type, raw content, raw hash] (the task's as in scrapedata with raw=True, None otherwise).
+        """
+        def claim(cur):
+            now=time.time()
+            cur.execute('''UPDATE taskqueue SET state=CASE WHEN attempts>=? THEN 3 ELSE 0 END,worker=NULL,lease=NULL
+                           WHERE queue=? AND state=1 AND lease<?;''',(self.maxattempts,queue,now))
+            ids=[x[0] for x in cur.execute('''SELECT id FROM taskqueue WHERE queue=? AND state=0 ORDER BY id LIMIT ?;''',(queue,n))]
+            cur.executemany('''UPDATE taskqueue SET state=1,worker=?,lease=?,attempts=attempts+1 WHERE id=?;''',
+                            [(worker,now+lease,i) for i in ids])
+            if not raw:
+                return [[x[0],None,None,None] for x in cur.execute('''SELECT item FROM taskqueue WHERE id IN ('''+
+                                                                   ','.join('?'*len(ids))+''') ORDER BY id;''',ids)]
+            return [[x[0],x[1],_unpack(x[2]),x[3]] for x in cur.execute('''SELECT q.item,d.scrape_task_type,d.scrape_task_content,d.raw_hash
+                        FROM taskqueue q LEFT JOIN scrapedata d ON d.scrape_task_uid=q.item
+                        WHERE q.id IN ('''+','.join('?'*len(ids))+''') GROUP BY q.id ORDER BY q.id;''',ids)]
+        return self._transaction(claim)
+
+    def heartbeat(self,queue,worker,items,lease=120):
+        """Renews worker's leases on items, returns how many it still holds."""
+        def heartbeat(cur):
+            return cur.execute('''UPDATE taskqueue SET lease=? WHERE queue=? AND worker=? AND state=1
+                                  AND item IN ('''+','.join('?'*len(items))+''');''',[time.time()+lease,queue,worker]+list(items)).rowcount
+        return self._transaction(heartbeat) if items else 0
+
+    def complete(self,queue,worker,results):
+        """Merges results of worker's leased items into scrapedata and marks them done. Each result is
+        [item, 'task', [uid, type, content, update, etag, last-modified]] (addTask of a gather),
+        [item, 'data', [dict, raw hash, version]] (done of a scrape) or [item, None, None] (no data).
+        Returns item -> 'done'/'wasdone'/'nodata' for the items worker still held.
+        """
+        def complete(cur):
+            items=[r[0] for r in results]
+            held=set(x[0] for x in cur.execute('''SELECT item FROM taskqueue WHERE queue=? AND worker=? AND state=1
+                                                  AND item IN ('''+','.join('?'*len(items))+''');''',[queue,worker]+items))
+            outcome={}
+            for it,kind,payload in results:
+                if it not in held or it in outcome:
+                    continue
+                if kind=='task':
+                    outcome[it]=self._mergeTask(cur,*payload)
+                elif kind=='data':
+                    packed=_pack(json.dumps(payload[0]),self.compress)
+                    cur.execute('''UPDATE scrapedata SET scrape_date=?,content=?,scrape_raw_hash=?,scrape_version=?
+                                   WHERE scrape_task_uid=?;''',(datetime.datetime.now(),packed,payload[1],payload[2],it))
+                    outcome[it]='done'
+                else:
+                    outcome[it]='nodata'
+            cur.executemany('''UPDATE taskqueue SET state=2,worker=NULL,lease=NULL WHERE queue=? AND item=?;''',
+                            [(queue,it) for it in outcome])
+            return outcome
+        return self._transaction(complete) if results else {}
+
+    def _mergeTask(self,cur,uid,ctype,content,update=False,etag=None,lastmodified=None):
+        # addTask, on the queue's connection
+        rawhash=_rawHash(content)
+        existing=cur.execute('''SELECT raw_hash,scrape_task_type,CASE WHEN raw_hash IS NULL THEN scrape_task_content END
+                                FROM scrapedata WHERE scrape_task_uid=?;''',(uid,)).fetchone()
+        if existing:
+            if not update or ((existing[0] or _rawHash(_unpack(existing[2])))==rawhash and existing[1]==ctype):
+                return 'wasdone'
+            cur.execute('''UPDATE scrapedata SET scrape_task_type=?,scrape_task_content=?,raw_hash=?,
+                           http_etag=COALESCE(?,http_etag),http_lastmodified=COALESCE(?,http_lastmodified)
+                           WHERE scrape_task_uid=?;''',(ctype,_pack(content,self.compress),rawhash,etag,lastmodified,uid))
+        else:
+            cur.execute('''INSERT INTO scrapedata(added_date,scrape_task_uid,scrape_task_type,scrape_task_content,skip,
+                           raw_hash,http_etag,http_lastmodified) VALUES (?,?,?,?,?,?,?,?);''',
+                        (datetime.datetime.now(),uid,ctype,_pack(content,self.compress),False,rawhash,etag,lastmodified))
+        return 'done'
+
+    def release(self,queue,worker,items=None):
+        """Hands worker's leased items (all of them if None) back to pending (failed if out of attempts)."""
+        def release(cur):
+            q='''UPDATE taskqueue SET state=CASE WHEN attempts>=? THEN 3 ELSE 0 END,worker=NULL,lease=NULL
+                 WHERE queue=? AND worker=? AND state=1'''
+            if items is None:
+                return cur.execute(q+';',(self.maxattempts,queue,worker)).rowcount
+            return cur.execute(q+' AND item IN ('+','.join('?'*len(items))+');',[self.maxattempts,queue,worker]+list(items)).rowcount
+        return self._transaction(release) if items is None or items else 0
+
+    def stats(self,queue):
+        with self.lock:
+            counts=dict(self.db.execute('''SELECT state,COUNT(*) FROM taskqueue WHERE queue=? GROUP BY state;''',(queue,)).fetchall())
+        return {s:counts.get(i,0) for i,s in enumerate(QUEUE_STATES)}
+
+    def close(self):
+        self.db.close()
+
+
+class QueueServer():
+    """Serves a SqliteQueue over http (json POSTs to /claim, /heartbeat, /complete, /release and /stats)
+    from a background thread, for HttpQueue workers. With a token, requests have to carry it; bound to anything
+    but loopback (e.g. host='0.0.0.0' for workers on other hosts) it can't do without one.
+    """
+    METHODS=('claim','heartbeat','complete','release','stats')
+
+    def __init__(self,queue,host='127.0.0.1',port=8765,token=None):
+        if not token and not (host=='localhost' or host=='::1' or host.startswith('127.')):
+            raise ValueError('a token is needed to serve the queue on '+host)
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn
+        server=self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version='HTTP/1.1'
+            disable_nagle_algorithm=True
+
+            def do_POST(self):
+                method=self.path.strip('/')
+                body=self.rfile.read(int(self.headers.get('Content-Length',0)))
+                if method not in server.METHODS or (server.token and not hmac.compare_digest(self.headers.get('X-Scrrry-Token','').encode('utf-8'),server.token.encode('utf-8'))):
+                    return self.reply(404 if method not in server.METHODS else 403,{'error':method})
+                try:
+                    self.reply(200,{'result':_wire(getattr(server.queue,method)(**_unwire(json.loads(body.decode('utf-8')))))})
+                except Exception as e:
+                    self.reply(500,{'error':repr(e)})
+
+            def reply(self,status,obj):
+                b=json.dumps(obj).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type','application/json')
+                self.send_header('Content-Length',str(len(b)))
+                self.end_headers()
+                self.wfile.write(b)
+
+            def log_message(self,*args):
+                pass
+
+        class Server(ThreadingMixIn,HTTPServer):
+            daemon_threads=True
+
+        self.queue=queue
+        self.token=token
+        self.httpd=Server((host,port),Handler)
+        self.address=self.httpd.server_address
+        t=threading.Thread(target=self.httpd.serve_forever)
+        t.daemon=True
+        t.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class HttpQueue():
+    """Client of a QueueServer, used by queueCycle like a SqliteQueue."""
+    def __init__(self,url,token=None,timeout=60):
+        self.url=url.rstrip('/')
+        self.headers={'X-Scrrry-Token':token} if token else {}
+        self.timeout=timeout
+
+    def _call(self,method,**kwargs):
+        r=requests.post(self.url+'/'+method,data=json.dumps(_wire(kwargs)),headers=self.headers,timeout=self.timeout)
+        if r.status_code!=200:
+            raise IOError('queue '+method+' failed: '+str(r.status_code)+' '+r.text[:200])
+        return _unwire(r.json()['result'])
+
+    def claim(self,queue,worker,n=20,lease=120,raw=False):
+        return self._call('claim',queue=queue,worker=worker,n=n,lease=lease,raw=raw)
+
+    def heartbeat(self,queue,worker,items,lease=120):
+        return self._call('heartbeat',queue=queue,worker=worker,items=items,lease=lease)
+
+    def complete(self,queue,worker,results):
+        return self._call('complete',queue=queue,worker=worker,results=results)
+
+    def release(self,queue,worker,items=None):
+        return self._call('release',queue=queue,worker=worker,items=items)
+
+    def stats(self,queue):
+        return self._call('stats',queue=queue)
+
+    def close(self):
+        pass
+
+
+
 class Scrape_Db():
-    def __init__(self,task_name,ver_check=True,multicall=False):
+    def __init__(self,task_name,ver_check=True,multicall=False,storage={}):
+        """storage={'wal':True,'commitevery':500,'commitinterval':5} switches to the indexed/batched storage mode:
+        unique index on scrape_task_uid, WAL journal and writes grouped into one commit
+        per 'commitevery' writes or 'commitinterval' seconds (flushed at cycle end and on close()).
+        'compress':'zlib' (or 'zstd') stores new raw and scraped content compressed, see compressStorage();
+        on its own it leaves the db in the plain mode.
+        """
         if not multicall:
             self.tim=[[time.time(),],]
             self.currenttimestamp=datetime.datetime.now().strftime("%c")
@@ -56,21 +1248,40 @@ class Scrape_Db():
         #check version
         if ver_check:
             print('## -= scrrry v'+VERSION+' =-',end=' ')
-            try:
-                v=requests.get('https://raw.githubusercontent.com/DGalbichek/scrrry/master/scrrry.py').text.split("VERSION='")[1].split("'")[0]
-                if v==VERSION:
-                    print('(Up to date.)')
-                else:
-                    print('\n!! current/latest version discrepancy:',VERSION,'/',v)
-                    print('!! (https://raw.githubusercontent.com/DGalbichek/scrrry/master/scrrry.py)')
-            except:
-                print('(Online version check failed.)')
+        self._vercheck=None
 
         self.task_name=task_name
+        self.dbpath=os.path.abspath(self.task_name+'-db.sqlite')
         self.db = sqlite3.connect(self.task_name+'-db.sqlite')
         self.cursor = self.db.cursor()
-        self.proxylist=[]
-        self.proxypos=0
+        self.storage=storage
+        # indexed/batched mode, anything asked for besides compression
+        self.batched=bool([k for k in storage if k!='compress'])
+        self._pendingwrites=0
+        self._lastcommit=time.time()
+        if self.batched and self.storage.get('wal',True):
+            self.cursor.execute('PRAGMA journal_mode=WAL;')
+            self.cursor.execute('PRAGMA synchronous=NORMAL;')
+        self._proxypool=None
+        self._proxylock=threading.Lock()
+        self.http=dict(HTTP_DEFAULTS)
+        self._sessions={}
+        self._validators={}
+        self._owner=threading.current_thread()
+        self._local=threading.local()
+        self._writer=None # thread writing to the db in a concurrent gather
+        self._queueing=False # in a queueCycle, where addTask results go to the queue
+        self.scheduler=None
+        self._robots=None
+        self._driverpool=None
+        self._queue=None
+        self.metrics=None
+        self._vars=None
+        self._dirtyvars=set()
+        self.tc_known=None
+        self.tc_version=None
+        self.tc_checkpoint=None
+        self.tc_columns=collections.OrderedDict()
 
         if not multicall:
             try:
@@ -82,45 +1293,242 @@ class Scrape_Db():
                             scrape_task_uid TEXT, scrape_task_type TEXT, scrape_task_content TEXT, skip BOOLEAN,
                             scrape_date TIMESTAMP, content TEXT);
                     ''')
+                self.cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS timelog( id INTEGER PRIMARY KEY, session TEXT, segment INTEGER, t REAL);
+                    ''')
+                self.cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS metrics( id INTEGER PRIMARY KEY, session TEXT, cycle TEXT, started REAL, data TEXT);
+                    ''')
+                self.cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS checkpoints( id INTEGER PRIMARY KEY, cyclekey TEXT, cycle TEXT, session TEXT,
+                            started REAL, updated REAL, total INTEGER, position INTEGER, ndone INTEGER, nwasdone INTEGER,
+                            nskipped INTEGER, nnodata INTEGER, elapsed REAL, finished BOOLEAN);
+                    ''')
+                existing=[x[1] for x in self.cursor.execute('PRAGMA table_info(scrapedata);').fetchall()]
+                for col,typ in SCRAPEDATA_COLUMNS:
+                    if col not in existing:
+                        self.cursor.execute('ALTER TABLE scrapedata ADD COLUMN '+col+' '+typ+';')
+                if not self.cursor.execute('''SELECT name FROM sqlite_master WHERE type='index' AND name='variables_name';''').fetchone():
+                    # one row per name (the latest), so that setVariable can upsert
+                    self.cursor.execute('''DELETE FROM variables WHERE id NOT IN (SELECT MAX(id) FROM variables GROUP BY variable_name);''')
+                    self.cursor.execute('''CREATE UNIQUE INDEX variables_name ON variables(variable_name);''')
                 self.db.commit()
             except Exception as e:
                 self.db.rollback()
                 raise e
 
+            if self.batched:
+                self._migrate()
+
             if self.getVariable('scrrryMeta')=='---':
                 self.setVariable('scrrryMeta',{'versionCreatedWith':VERSION,'creationDateTime':datetime.datetime.now().strftime("%c")})
-            self.setVariable('scrrryLog-'+self.currenttimestamp,json.dumps(self.tim))
+            self._logTime(0,self.tim[0][0])
+
+        if ver_check:
+            self._checkVersion(cached=not multicall)
+
+
+    ##
+    ##  VERSION
+    ##
+    def _checkVersion(self,cached=True):
+        # reports the latest version from the cache if it's recent, otherwise looks it up in a daemon thread,
+        # reported by the next cycle or close() (see _versionResult)
+        last=self.getVariable('scrrryLatest',{}) if cached else {}
+        if last and time.time()-last.get('checked',0)<VERSION_CHECK['ttl']:
+            self._reportVersion(last.get('version'))
+            return
+        self._vercheck={'cache':cached}
+        def lookup(result,timeout):
+            try:
+                result['version']=requests.get(VERSION_URL,timeout=timeout).text.split("VERSION='")[1].split("'")[0]
+            except Exception:
+                result['version']=None
+        t=threading.Thread(target=lookup,args=(self._vercheck,VERSION_CHECK['timeout']))
+        t.daemon=True
+        t.start()
+        print('(Checking for a newer version in the background.)')
+
+
+    def _versionResult(self):
+        if self._vercheck is None or 'version' not in self._vercheck:
+            return
+        v,cache=self._vercheck['version'],self._vercheck['cache']
+        self._vercheck=None
+        print('## -= scrrry v'+VERSION+' =-',end=' ')
+        self._reportVersion(v)
+        if cache:
+            self.setVariable('scrrryLatest',{'version':v,'checked':time.time()})
+
+
+    def _reportVersion(self,v):
+        if not v:
+            print('(Online version check failed.)')
+        elif v==VERSION:
+            print('(Up to date.)')
+        else:
+            print('\n!! current/latest version discrepancy:',VERSION,'/',v)
+            print('!! ('+VERSION_URL+')')
+
+
+    ##
+    ##  STORAGE
+    ##
+    def _migrate(self):
+        """Brings an existing db up to the storage mode's schema (duplicate tasks dropped, unique uid index).
+        """
+        dupes=self.cursor.execute('''SELECT COUNT(*)-COUNT(DISTINCT scrape_task_uid) FROM scrapedata;''').fetchone()[0]
+        if dupes:
+            # keep the scraped row for each uid if there is one, the oldest one otherwise
+            self.cursor.execute('''DELETE FROM scrapedata WHERE id NOT IN (
+                                    SELECT (SELECT id FROM scrapedata d WHERE d.scrape_task_uid=u.scrape_task_uid
+                                            ORDER BY d.content IS NULL, d.id LIMIT 1)
+                                    FROM (SELECT DISTINCT scrape_task_uid FROM scrapedata) u);''')
+            print('## Storage migration: removed',dupes,'duplicate tasks.',sep=' ')
+        self.cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS scrapedata_uid ON scrapedata(scrape_task_uid);''')
+        self.db.commit()
+
+
+    def _commit(self):
+        """Commits straight away, or in storage mode only once enough writes or time have piled up.
+        """
+        if not self.batched:
+            self.db.commit()
+            return
+        self._pendingwrites+=1
+        if self._pendingwrites>=self.storage.get('commitevery',500) or \
+           time.time()-self._lastcommit>=self.storage.get('commitinterval',5):
+            self.flush()
+
+
+    def _dbTime(self,t0):
+        # db time of the running cycle (calls made on the thread owning the db)
+        if self.metrics is not None and self.metrics.ended is None and threading.current_thread() is self._owner:
+            self.metrics.db+=time.time()-t0
+
+
+    def flush(self):
+        """Commits any pending writes.
+        """
+        t0=time.time()
+        self.flushVariables()
+        self.db.commit()
+        self._dbTime(t0)
+        self._pendingwrites=0
+        self._lastcommit=time.time()
+
+
+    def _readCursor(self):
+        """Cursor for lookups, a per thread read-only connection when called off the thread that owns self.db.
+        """
+        if threading.current_thread() is self._owner:
+            return self.cursor
+        if not hasattr(self._local,'db'):
+            try:
+                from urllib.request import pathname2url
+            except ImportError:
+                from urllib import pathname2url
+            self._local.db=sqlite3.connect('file:'+pathname2url(os.path.abspath(self.task_name+'-db.sqlite'))+'?mode=ro',uri=True)
+        return self._local.db.cursor()
+
+
+    def close(self):
+        """Flushes pending writes and closes the db (and quits the browsers of the driver pool).
+        """
+        self._versionResult()
+        if self._driverpool is not None:
+            self._driverpool.close()
+        if self._queue is not None:
+            self._queue.close()
+        self.saveProxyPool()
+        self.flush()
+        self.db.close()
+
+
+
+
+    def storageStats(self):
+        """Returns bytes held in the raw/scraped content columns, how many values are compressed and the db file size.
+        """
+        r=self.cursor.execute('''SELECT COUNT(*),
+                                        SUM(LENGTH(CAST(scrape_task_content AS BLOB))),SUM(LENGTH(CAST(content AS BLOB))),
+                                        SUM(SUBSTR(scrape_task_content,1,?)=?),SUM(SUBSTR(content,1,?)=?)
+                                 FROM scrapedata;''',(len(COMPRESS_MARK),COMPRESS_MARK)*2).fetchone()
+        return {'tasks':r[0],'rawbytes':r[1] or 0,'contentbytes':r[2] or 0,
+                'rawcompressed':r[3] or 0,'contentcompressed':r[4] or 0,
+                'filebytes':os.path.getsize(self.task_name+'-db.sqlite')}
+
+
+    def compressStorage(self,method='zlib',batch=1000,vacuum=True):
+        """Rewrites raw and scraped content of existing tasks in place with method ('zlib' or 'zstd'),
+        or back to plain values with method=None, then vacuums the db and prints the space saved.
+        """
+        before=self.storageStats()
+        print('## ... Compressing storage >',method,sep=' ',end=' ')
+        self.flush()
+        lastid=0
+        while True:
+            rows=self.cursor.execute('''SELECT id,scrape_task_content,content FROM scrapedata WHERE id>? ORDER BY id LIMIT ?;''',
+                                     (lastid,batch)).fetchall()
+            if not rows:
+                break
+            self.cursor.executemany('''UPDATE scrapedata SET scrape_task_content=?,content=? WHERE id=?;''',
+                                    [(_pack(_unpack(r[1]),method),_pack(_unpack(r[2]),method),r[0]) for r in rows])
+            self.db.commit()
+            lastid=rows[-1][0]
+        if vacuum:
+            self.cursor.execute('VACUUM;')
+        after=self.storageStats()
+        print('Done.')
+        print('## content',before['rawbytes']+before['contentbytes'],'>',after['rawbytes']+after['contentbytes'],'bytes,',
+              'file',before['filebytes'],'>',after['filebytes'],'bytes',sep=' ')
+        return after
+
+
 
 
     ##
     ##  VARIABLES
     ##
+    def _variables(self):
+        # name -> json text of all variables, read from the db once
+        if self._vars is None:
+            self._vars=dict(self.cursor.execute('''SELECT variable_name,variable_content FROM variables;''').fetchall())
+        return self._vars
+
+
     def setVariable(self,var,val):
         """Either creates variable or updates the value of the one that already exists with the name.
+        In storage mode the db is only written on flush (write-behind), otherwise straight away.
         """
-        if not self.cursor.execute('''SELECT variable_name FROM variables WHERE variable_name=?;''',(var,)).fetchone():
-            self.cursor.execute('''INSERT INTO variables(variable_name, variable_content)
-                                VALUES (?,?);''', (var,json.dumps(val)))
-        elif var:
-            self.cursor.execute('''UPDATE variables SET variable_content=?
-                                WHERE variable_name=?;''', (json.dumps(val),var))
-        self.db.commit()
+        self._variables()[var]=json.dumps(val)
+        self._dirtyvars.add(var)
+        if not self.batched:
+            self.flushVariables()
+            self.db.commit()
+
+
+    def flushVariables(self):
+        """Writes variables changed since the last flush, one upsert each.
+        """
+        if self._dirtyvars:
+            self.cursor.executemany('''INSERT INTO variables(variable_name, variable_content) VALUES (?,?)
+                                    ON CONFLICT(variable_name) DO UPDATE SET variable_content=excluded.variable_content;''',
+                                    [(v,self._vars[v]) for v in self._dirtyvars])
+            self._dirtyvars=set()
 
 
     def getVariable(self,var,novar='---'):
         """Retreives value of variable or returns a default if doesn't exist yet.
         """
-        if self.cursor.execute('''SELECT variable_content FROM variables WHERE variable_name=?;''',(var,)).fetchone():
-            #print self.cursor.execute('''SELECT variable_content FROM variables WHERE variable_name=?;''',(var,)).fetchone()[0]
-            return json.loads(self.cursor.execute('''SELECT variable_content FROM variables WHERE variable_name=?;''',(var,)).fetchone()[0])
-        else:
-            return novar
+        v=self._variables().get(var)
+        return json.loads(v) if v is not None else novar
 
 
     def listVariables(self):
         """Returns list of ALL variables.
         """
-        return [x[0] for x in self.cursor.execute('''SELECT variable_name FROM variables;''').fetchall()]
+        return list(self._variables())
 
 
 
@@ -138,7 +1546,7 @@ class Scrape_Db():
             self.tim[-1].append(time.time())
 
         # saving time log
-        self.setVariable('scrrryLog-'+self.currenttimestamp,json.dumps(self.tim))
+        self._logTime(len(self.tim)-1,self.tim[-1][-1])
 
         if total: # segment total
             t=self.tim[-1][-1]-self.tim[-1][0]
@@ -163,10 +1571,32 @@ class Scrape_Db():
         return r.strip()
 
 
+    def _logTime(self,segment,t):
+        self.cursor.execute('''INSERT INTO timelog(session,segment,t) VALUES (?,?,?);''',(self.currenttimestamp,segment,t))
+        self._commit()
+
+
+    def timeLog(self,session=None):
+        """Tick times of a session (the current one by default) as a list of segments, like self.tim.
+        """
+        segs=collections.OrderedDict()
+        for seg,t in self.cursor.execute('''SELECT segment,t FROM timelog WHERE session=? ORDER BY id;''',
+                                         (session or self.currenttimestamp,)).fetchall():
+            segs.setdefault(seg,[]).append(t)
+        return list(segs.values())
+
+
+    def _offWriter(self):
+        # on a worker thread of a concurrent gather, where db writes and counters are handed back to the writer thread
+        return self._writer is not None and threading.current_thread() is not self._writer
+
+
     def tc_done(self,standalone=False):
         if standalone:
             print('DONE',end=' ')
             return
+        if self._offWriter():
+            return _DeferredPrompt('done',())
         self.tc_ndone+=1
         if self.tc_disptype=='verbose':
             return 'DONE'+'\n'
@@ -178,6 +1608,8 @@ class Scrape_Db():
         if standalone:
             print('was already done',end=' ')
             return
+        if self._offWriter():
+            return _DeferredPrompt('wasdone',(plus,))
         self.tc_nwasdone+=1
         if self.tc_disptype=='verbose':
             return 'was already done '+plus+'\n'
@@ -189,6 +1621,8 @@ class Scrape_Db():
         if standalone:
             print('SKIPPED',end=' ')
             return
+        if self._offWriter():
+            return _DeferredPrompt('skipped',(plus,))
         self.tc_nskipped+=1
         if self.tc_disptype=='verbose':
             return 'is SKIPPED '+plus+'\n'
@@ -200,6 +1634,8 @@ class Scrape_Db():
         if standalone:
             print('NO DATA',end=' ')
             return
+        if self._offWriter():
+            return _DeferredPrompt('nodata',(plus,))
         self.tc_nnodata+=1
         if self.tc_disptype=='verbose':
             return 'NO DATA obtained '+plus+'\n'
@@ -234,14 +1670,42 @@ class Scrape_Db():
 
 
     def taskCycle(self,algofunct,iterr='def',display={'type':'verbose','freq':1,'tick':0},
-                  unfold='',checktodo=False,nosubmit=False,multi={}):
+                  unfold='',checktodo=False,nosubmit=False,multi={},concurrent={},sink=None,version=None,checkpoint={}):
         """Wrapper for gather and scrape tasks. Deals with time and output management.
+        iterr is a list of task uids, 'def' for all tasks, a state ('pending', 'done', 'skipped') or a selectTasks() selection,
+        the latter ones read from the db as the cycle goes.
+        concurrent={'workers':16,'perhost':4} runs gatherTask in a thread pool, interleaving hosts,
+        with at most 'perhost' requests in flight to any one host; 'rate' caps requests/s per host,
+        'robots':True honours robots.txt crawl-delay, 'adaptive':False turns off backing off throttling hosts
+        (see HostScheduler). gatherTask then runs on worker threads: addTask and the tc_ prompts are handed back
+        to the cycle's thread, other calls writing to the db are not to be made from it (fetch/render are fine).
+        With a sink (see CsvSink and co.) rows are written as they come and not kept in memory.
+        Scraping redoes tasks whose raw content changed since they were done, and with version
+        (any tag of the scrapeTask revision, e.g. '2') also the ones done with another version.
+        checkpoint={'every':500,'interval':60} commits and records the cycle's progress every so many tasks/seconds,
+        a rerun of an interrupted cycle (same function, version and iterr) carries on from the last checkpoint.
+        """
+        data=[]
+        for d in self.iterTaskCycle(algofunct,iterr,display,unfold,checktodo,nosubmit,multi,concurrent,version,checkpoint):
+            if sink is not None:
+                sink.write(d)
+            else:
+                data.append(d)
+        return data
+
+
+    def iterTaskCycle(self,algofunct,iterr='def',display={'type':'verbose','freq':1,'tick':0},
+                  unfold='',checktodo=False,nosubmit=False,multi={},concurrent={},version=None,checkpoint={}):
+        """Generator version of taskCycle, yields the scraped rows as they are produced.
         """
 
         # Cycle start
+        self._versionResult()
         ti=self.tick(display=False,newcycle=True,currenttime=True)
         if iterr=='def':
-            iterr=self.toDo()
+            iterr=self.selectTasks()
+        elif isinstance(iterr,str) and iterr in TASK_STATES:
+            iterr=self.selectTasks(iterr,version=version)
         print()
         if 'name' in display.keys() and display['name']: # optional name for cycle
             print('## <[',display['name'],']>',sep=' ')
@@ -250,7 +1714,14 @@ class Scrape_Db():
 
         self.tc_ndone,self.tc_nwasdone,self.tc_nskipped,self.tc_nnodata=0,0,0,0
         self.tc_disptype=display['type']
-        data=[]
+        self.tc_known=set(self.toDo()) if checktodo else None
+        self.tc_version=None if version is None else str(version)
+        self.tc_columns=collections.OrderedDict()
+        self.metrics=CycleMetrics(algofunct.__name__,self.currenttimestamp)
+        self.tc_checkpoint=self._checkpointStart(algofunct.__name__,iterr,checkpoint) if checkpoint else None
+        # tasks before this position were settled in an interrupted run of the cycle
+        resumeat=self.tc_checkpoint['position'] if self.tc_checkpoint else 0
+        out=collections.deque()
 
         def preprint(n,it):
             # whether or not display task name
@@ -260,115 +1731,227 @@ class Scrape_Db():
                 elif display['type']=='brief':
                     pass
 
-        def postprint(n,multi=False):
+        def postprint(n):
             # outputting prompt of completion
-            if not multi:
-                if display['type']!='none' and (display['freq']==1 or (n+1)%display['freq']==0):
-                    print(pr,end=' ')
+            self.metrics.elements+=1
+            if display['type']!='none' and (display['freq']==1 or (n+1)%display['freq']==0):
+                print(pr,end=' ')
 
 
-            if multi or display['tick']!=0 and n%display['tick']==display['tick']-1:
+            if display['tick']!=0 and n%display['tick']==display['tick']-1:
                 if display['type']=='verbose':
-                    print('##',self.tick(),sep=' ',end=' ')
+                    print('##',self.tick()+self._eta()+self.metrics.pageLatency(),sep=' ',end=' ')
                 elif display['type']=='brief':
                     perc='['+str(int(float(n+1)/len(iterr)*100))+'%]' # percentage
-                    print(str(n+1)+perc+'('+self.tick()+')',end=' ')
+                    print(str(n+1)+perc+'('+self.tick()+')'+self._eta()+self.metrics.pageLatency(),end=' ')
+
+        def mark(i,before=None):
+            # task i of iterr is settled, before: counters ahead of settling a task the interrupted run counted already
+            if self.tc_checkpoint is not None:
+                if before is not None and i<resumeat:
+                    self.tc_checkpoint['recounted']=[a+c-b for a,b,c in zip(self.tc_checkpoint['recounted'],before,self._counters())]
+                self._checkpointMark(i)
+
+        def adddata(dii):
+            for d in (self.tc_unfold(dii,unfold) if unfold else [dii]):
+                if d:
+                    for k in d:
+                        if k not in self.tc_columns:
+                            self.tc_columns[k]=None
+                out.append(d)
+
+        def settled(it,wasdone,content=None):
+            # completion prompt for tasks that are done already or skipped
+            if wasdone and wasdone!='SKIP':
+                adddata(json.loads(_unpack(content)) if content is not None else self.content(it))
+                return self.tc_wasdone(wasdone)
+            elif wasdone=='SKIP':
+                return self.tc_skipped(wasdone)
+
+        def submit(it,dii):
+            # completion prompt for a freshly scraped task
+            if dii:
+                adddata(dii)
+                if not nosubmit and dii:
+                    self.done(it,dii)
+                    return self.tc_done()
+            return self.tc_nodata()
+
+
+
+        # Core loop - GATHER - concurrent
+        if algofunct.__name__=='gatherTask' and concurrent:
+            from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+            WORKERS=concurrent.get('workers',8)
+            PERHOST=concurrent.get('perhost',WORKERS)
+            print('** CONCURRENT GATHER ** '+str(WORKERS)+'/'+str(PERHOST))
+
+            sched=self.scheduler=HostScheduler(PERHOST,concurrent.get('rate'),concurrent.get('adaptive',True),
+                                               concurrent.get('maxdelay',60),concurrent.get('robots',False))
+            if sched.robots:
+                self._robotsCache()
+            n=resumeat
+            queued=set() # repeats in iterr are settled like known tasks, as in the sequential gather
+            for i,it in itertools.islice(enumerate(iterr),resumeat,None):
+                if checktodo and (it in self.tc_known or it in queued):
+                    preprint(n,it)
+                    pr=self.tc_wasdone()
+                    postprint(n)
+                    mark(i)
+                    n+=1
+                else:
+                    if checktodo:
+                        queued.add(it)
+                    sched.add(i,it,_host(it))
+            inflight={}
 
+            # only this thread touches sqlite, workers hand their addTask calls back to it
+            self._writer=threading.current_thread()
+            try:
+                with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+                    while sched or inflight:
+                        for h,scheme in sched.waitingRobots():
+                            inflight[pool.submit(self._crawlDelay,h,scheme)]=(None,None,h)
+                        sched.due=None
+                        while len(inflight)<WORKERS:
+                            nxt=sched.next()
+                            if nxt is None:
+                                break
+                            inflight[pool.submit(_timedCall,algofunct,nxt[1])]=nxt
+
+                        if not inflight:
+                            time.sleep(sched.due or .05)
+                            continue
+
+                        finished,_=wait(inflight,timeout=sched.due,return_when=FIRST_COMPLETED)
+                        for f in finished:
+                            i,it,h=inflight.pop(f)
+                            if it is None:
+                                sched.setCrawlDelay(h,self._saveCrawlDelay(h,f.result()))
+                                continue
+                            preprint(n,it)
+                            pr,sec=f.result()
+                            sched.finished(h,sec)
+                            self.metrics.task(sec,h)
+                            if isinstance(pr,_DeferredTask):
+                                pr=self.addTask(pr.uid,pr.ctype,pr.content,pr.testing,update=pr.update)
+                            elif isinstance(pr,_DeferredPrompt):
+                                pr=getattr(self,'tc_'+pr.kind)(*pr.args)
+                            postprint(n)
+                            mark(i)
+                            n+=1
+            finally:
+                self._writer=None
+                self.scheduler=None
+                self.metrics.hoststats=sched.stats()
 
 
         # Core loop - GATHER
-        if algofunct.__name__=='gatherTask':
-            for n,it in enumerate(iterr):
+        elif algofunct.__name__=='gatherTask':
+            for n,it in itertools.islice(enumerate(iterr),resumeat,None):
                 preprint(n,it)
 
-                if not checktodo or (checktodo and it not in self.toDo()):
-                    pr=algofunct(it)
+                if not checktodo or it not in self.tc_known:
+                    pr,sec=_timedCall(algofunct,it)
+                    self.metrics.task(sec,_host(it))
                 else:
                     pr=self.tc_wasdone()
 
                 postprint(n)
+                mark(n)
 
 
         # Core loop - SCRAPE - single thread
         elif algofunct.__name__=='scrapeTask' and not multi:
-            for n,it in enumerate(iterr):
+            # task states come in pages, raw content is handed to parse_task with the task
+            for n,(it,row) in enumerate(self._taskRows(iterr)):
                 preprint(n,it)
-
-                wasdone=self.istoDo(it)
-                if wasdone and wasdone!='SKIP':
-                    if unfold:
-                        for d in self.tc_unfold(self.content(it),unfold):
-                            data.append(d)
-                    else:
-                        data.append(self.content(it))
-                    pr=self.tc_wasdone(wasdone)
-                elif wasdone=='SKIP':
-                    pr=self.tc_skipped(wasdone)
+                before=self._counters()
+
+                wasdone=self._state(row[0],row[1]) if row else ''
+                if wasdone:
+                    pr=settled(it,wasdone,row[4])
+                elif n<resumeat or row is None:
+                    # came to nothing in the interrupted run, or not a task
+                    pr=self.tc_nodata()
                 else:
-                    dii=algofunct(it)
-                    if dii:
-                        if unfold:
-                            for d in self.tc_unfold(dii,unfold):
-                                data.append(d)
-                        else:
-                            data.append(dii)
-                        if not nosubmit and dii:
-                            self.done(it,dii)
-                            pr=self.tc_done()
-                        else:
-                            pr=self.tc_nodata()
-                    else:
-                        pr=self.tc_nodata()
+                    _PREFETCHED[(self.dbpath,it)]=(row[2],row[3])
+                    try:
+                        dii,sec=_timedCall(algofunct,it)
+                    finally:
+                        _PREFETCHED.pop((self.dbpath,it),None)
+                    self.metrics.task(sec)
+                    pr=submit(it,dii)
 
                 postprint(n)
+                mark(n,before)
+                while out:
+                    yield out.popleft()
 
 
-        # Core loop - SCRAPE - multi thread
+        # Core loop - SCRAPE - multi process
         elif algofunct.__name__=='scrapeTask' and multi:
-            LIMIT=len(iterr)
-            BATCHSIZE=multi['batchsize']
             NOOFPROC=multi['noofproc']
-            print('** POOL PARTY! ** '+str(BATCHSIZE)+'/'+str(NOOFPROC),end='')
+            CHUNKSIZE=multi.get('chunksize',8)
+            print('** POOL PARTY! ** '+str(CHUNKSIZE)+'/'+str(NOOFPROC))
+
+            # done and skipped tasks are settled here, only the rest goes to the pool
+            n=0
+            pending=[]
+            pendingat=collections.defaultdict(collections.deque)
+            repeats=[] # uids already on their way to the pool, settled once it's done
+            for i,(it,row) in enumerate(self._taskRows(iterr,raw=False)):
+                wasdone=self._state(row[0],row[1]) if row else ''
+                if wasdone or i<resumeat or row is None:
+                    preprint(n,it)
+                    before=self._counters()
+                    pr=settled(it,wasdone,row[4]) if wasdone else self.tc_nodata()
+                    postprint(n)
+                    mark(i,before)
+                    n+=1
+                    while out:
+                        yield out.popleft()
+                elif it in pendingat:
+                    repeats.append((i,it))
+                else:
+                    pending.append(it)
+                    pendingat[it].append(i)
 
+            # tasks are streamed to the workers along with their raw content, read here in batches,
+            # so workers only parse; results are written back here as they arrive (in completion order)
+            self.flush()
             from multiprocessing import Pool
-            pool = Pool(processes=NOOFPROC)
-            #print('limit',LIMIT,'batch',BATCHSIZE,'noofproc',NOOFPROC,'-',math.ceil(LIMIT/BATCHSIZE))
-            # batch creation
-            for nn in range(int(LIMIT/BATCHSIZE)+1):
-                #print(nn,(nn*BATCHSIZE,nn*BATCHSIZE+BATCHSIZE,))
-                b1,b2=[],[]
-                for rrr in range(NOOFPROC):
-                    st=nn*BATCHSIZE+BATCHSIZE/NOOFPROC*rrr
-                    if st<LIMIT:
-                        b1.append(st)
-                        en=nn*BATCHSIZE+BATCHSIZE/NOOFPROC*(rrr+1)
-                        if en>LIMIT:
-                            b2.append(LIMIT)
-                        else:
-                            if rrr+1==NOOFPROC:
-                                b2.append((nn+1)*BATCHSIZE)
-                            else:
-                                b2.append(en)
-                b1=[int(x) for x in b1]
-                b2=[int(x) for x in b2]
-                #print(b1,b2)
-                print()
-                print(list(zip(b1,b2)),end=' === ')
-
-                res=pool.map_async(algofunctMultiWrapper, [(algofunct, iterr, x) for x in zip(b1,b2)])
-                for r in res.get():
-                    if unfold:
-                        for rr in r:
-                            for d in self.tc_unfold(rr,unfold):
-                                data.append(d)
-                    else:
-                        for rr in r:
-                            data.append(rr)
-
-                postprint(min((nn+1)*BATCHSIZE-1,LIMIT-1), multi=True)
+            with Pool(processes=NOOFPROC,initializer=_multiInit,initargs=(algofunct,self.dbpath)) as pool:
+                for it,dii,sec in pool.imap_unordered(_multiScrape,self._rawContentPages(pending),chunksize=CHUNKSIZE):
+                    self.metrics.task(sec)
+                    preprint(n,it)
+                    pr=submit(it,dii)
+                    postprint(n)
+                    mark(pendingat[it].popleft())
+                    n+=1
+                    while out:
+                        yield out.popleft()
+            for i,it in repeats:
+                preprint(n,it)
+                before=self._counters()
+                row=next(self._taskRows([it],raw=False))[1]
+                wasdone=self._state(row[0],row[1])
+                pr=settled(it,wasdone,row[4]) if wasdone else self.tc_nodata()
+                postprint(n)
+                mark(i,before)
+                n+=1
+                while out:
+                    yield out.popleft()
 
 
         # Cycle end
+        self.tc_known=None
+        self.tc_version=None
+        self.saveProxyPool()
+        self.flush()
+        if self.tc_checkpoint is not None:
+            self._checkpoint(finished=True)
+            self.tc_checkpoint=None
         if display['type']=='brief':
             print()
         print('##\n##',algofunct.__name__,'task cycle complete -',sep=' ',end=' ')
@@ -382,15 +1965,109 @@ class Scrape_Db():
         if self.tc_nnodata:
             stats+='/x'+str(self.tc_nnodata)
         print(stats,'-',self.tick(total=True, currenttime=True),sep=' ')
+        self._saveMetrics()
 
         #list of column names
-        if data:
-            print('## Available columns:', self._dataColumnsAvailable(data),sep=' ')
-        return data
+        if self.tc_columns:
+            print('## Available columns:', list(self.tc_columns),sep=' ')
+
+
+    def _checkpointStart(self,cycle,iterr,checkpoint):
+        # picks up the last checkpoint of an unfinished run of the same cycle, or starts a new one
+        h=hashlib.sha1((cycle+'\x00'+str(self.tc_version)+'\x00').encode('utf-8'))
+        for it in iterr:
+            h.update(str(it).encode('utf-8')+b'\x00')
+        key=h.hexdigest()
+        ckp={'every':checkpoint.get('every',500),'interval':checkpoint.get('interval',60),'key':key,
+             'total':len(iterr),'position':0,'marks':set(),'base':(0,0,0,0),'recounted':[0,0,0,0],
+             'elapsed':0.,'started':time.time()}
+        last=self.cursor.execute('''SELECT id,finished,position,ndone,nwasdone,nskipped,nnodata,elapsed,session
+                                    FROM checkpoints WHERE cyclekey=? ORDER BY id DESC LIMIT 1;''',(key,)).fetchone()
+        if last and not last[1] and checkpoint.get('resume',True):
+            ckp.update(id=last[0],position=last[2],base=tuple(last[3:7]),elapsed=last[7])
+            print('## resuming run of',last[8],'at',str(last[2])+'/'+str(len(iterr)),
+                  '- t'+str(last[2])+'/='+str(last[4])+'/+'+str(last[3])+'/s'+str(last[5])+'/x'+str(last[6]),sep=' ')
+            print('##')
+        else:
+            self.cursor.execute('''INSERT INTO checkpoints(cyclekey,cycle,session,started,updated,total,position,
+                                ndone,nwasdone,nskipped,nnodata,elapsed,finished) VALUES (?,?,?,?,?,?,0,0,0,0,0,0,0);''',
+                                (key,cycle,self.currenttimestamp,ckp['started'],ckp['started'],len(iterr)))
+            ckp['id']=self.cursor.lastrowid
+            self._commit()
+        ckp['lastn'],ckp['last'],ckp['resumedat']=ckp['position'],time.time(),ckp['position']
+        return ckp
+
+
+    def _checkpointMark(self,i):
+        # advances the low-water mark (all tasks before it settled) and checkpoints when it's due
+        ckp=self.tc_checkpoint
+        ckp['marks'].add(i)
+        while ckp['position'] in ckp['marks']:
+            ckp['marks'].discard(ckp['position'])
+            ckp['position']+=1
+        if ckp['position']-ckp['lastn']>=ckp['every'] or time.time()-ckp['last']>=ckp['interval']:
+            self._checkpoint()
+
+
+    def _checkpoint(self,finished=False):
+        # everything settled so far is committed before the position is
+        ckp=self.tc_checkpoint
+        self.flush()
+        counts=[b+c-r for b,c,r in zip(ckp['base'],self._counters(),ckp['recounted'])]
+        self.cursor.execute('''UPDATE checkpoints SET updated=?,position=?,ndone=?,nwasdone=?,nskipped=?,nnodata=?,
+                            elapsed=?,finished=? WHERE id=?;''',
+                            [time.time(),ckp['position']]+counts+[ckp['elapsed']+time.time()-ckp['started'],finished,ckp['id']])
+        self.db.commit()
+        ckp['lastn'],ckp['last']=ckp['position'],time.time()
+
+
+    def _counters(self):
+        return (self.tc_ndone,self.tc_nwasdone,self.tc_nskipped,self.tc_nnodata)
+
+
+    def _eta(self):
+        # ' eta ..' of a checkpointed cycle, from the pace of this run
+        ckp=self.tc_checkpoint
+        if ckp is None or ckp['position']<=ckp['resumedat']:
+            return ''
+        t=(ckp['total']-ckp['position'])*(time.time()-ckp['started'])/(ckp['position']-ckp['resumedat'])
+        return ' eta %ih %im' % (int(t/3600),int(t/60)%60)
+
+
+    def checkpoints(self,unfinished=False):
+        """Recorded cycle runs (latest first) with their progress, overall counters and elapsed seconds.
+        """
+        cols=['id','cycle','session','started','updated','total','position','ndone','nwasdone','nskipped','nnodata','elapsed','finished']
+        return [dict(zip(cols,x)) for x in self.cursor.execute('SELECT '+','.join(cols)+' FROM checkpoints'+
+                                                               (' WHERE NOT finished' if unfinished else '')+' ORDER BY id DESC;').fetchall()]
+
+
+    def _saveMetrics(self):
+        self.metrics.ended=time.time()
+        m=self.metrics.summary()
+        self.cursor.execute('''INSERT INTO metrics(session,cycle,started,data) VALUES (?,?,?,?);''',
+                            (self.metrics.session,self.metrics.cycle,self.metrics.started,json.dumps(m)))
+        self._commit()
+        line=['## %.2f tasks/s' % (m['elements_per_s'] or 0)]
+        if m['tasks']:
+            line.append('- p50/p95 '+str(m['task_p50'])+'s/'+str(m['task_p95'])+'s')
+        line.append('- in/out %.1f/%.1fkB' % (m['bytes_in']/1024.,m['bytes_out']/1024.))
+        line.append('- callback/db %.2fs/%.2fs' % (m['callback_s'],m['db_s']))
+        print(*line,sep=' ')
+
+
+    def metricsHistory(self,cycle=None,limit=20):
+        """Saved metrics summaries of past cycles, latest first.
+        """
+        q='''SELECT data FROM metrics'''+(''' WHERE cycle=?''' if cycle else '')+''' ORDER BY id DESC LIMIT ?;'''
+        return [json.loads(x[0]) for x in self.cursor.execute(q,((cycle,) if cycle else ())+(limit,)).fetchall()]
 
 
     def unusedColumns(self,data,columns):
-        print('\n## Unused columns:', [x for x in self._dataColumnsAvailable(data) if x not in columns])
+        """Pass data=None to check against the columns seen in the last cycle (e.g. when it went to a sink).
+        """
+        available=list(self.tc_columns) if data is None else self._dataColumnsAvailable(data)
+        print('\n## Unused columns:', [x for x in available if x not in columns])
 
 
     def deleteTask(self,uid,feedback=True):
@@ -400,7 +2077,9 @@ class Scrape_Db():
             uid=[uid,]
         for uu in uid:
             self.cursor.execute('DELETE FROM scrapedata WHERE scrape_task_uid=?;',(uu,))
-            self.db.commit()
+            self._commit()
+            if self.tc_known is not None:
+                self.tc_known.discard(uu)
             if feedback:
                 print('## DELETED',uu,sep=' ')
         return True
@@ -410,7 +2089,7 @@ class Scrape_Db():
         """Delete specified completed tasks but keeping tha tasks themselves.
         """
         self.cursor.execute('UPDATE scrapedata SET scrape_date=NULL,content=NULL WHERE scrape_task_uid=?;',(uid,))
-        self.db.commit()
+        self._commit()
         if feedback:
             print('## CLEARED',uid,sep=' ')
         return True
@@ -420,25 +2099,331 @@ class Scrape_Db():
         """Delete all completed tasks but keeping tha tasks themselves.
         """
         self.cursor.execute('UPDATE scrapedata SET scrape_date=NULL,content=NULL;')
-        self.db.commit()
+        self._commit()
         if feedback:
             print('## Completed tasks cleared.')
         return True
 
 
-    def to_excel(self):
-        """Dumps scraping database in an excel sheet.
+    def to_excel(self,raw=True,chunksize=5000):
+        """Dumps scraping database in an excel sheet, streamed a chunk of rows at a time, a new sheet is started at
+        Excel's row limit (as for ExcelSink). raw=False leaves out the raw task content. For the scraped data see exportResults.
         """
         filename=self.task_name+'-dbexport.xlsx'
         print('## ... Dumping DB to Excel spreadsheet >',filename,sep=' ')
+        self.flush()
+        import xlsxwriter
+        workbook=xlsxwriter.Workbook(filename,{'constant_memory':True,'strings_to_urls':False})
+        try:
+            for ddd in ['scrapedata','variables']:
+                cols=[x[1] for x in self.cursor.execute('PRAGMA table_info('+ddd+');').fetchall()
+                      if raw or x[1]!='scrape_task_content']
+                def sheet(k):
+                    suffix='' if k==1 else str(k)
+                    ws=workbook.add_worksheet((self.task_name+ddd)[:31-len(suffix)]+suffix)
+                    ws.write_row(0,0,['']+cols)
+                    return ws
+                ws=sheet(1)
+                r,lastid=0,0
+                while True:
+                    rows=self.cursor.execute('SELECT '+','.join(cols)+' FROM '+ddd+' WHERE id>? ORDER BY id LIMIT ?;',
+                                             (lastid,chunksize)).fetchall()
+                    if not rows:
+                        break
+                    for row in rows:
+                        if r and r%ExcelSink.MAXROWS==0:
+                            ws=sheet(r//ExcelSink.MAXROWS+1)
+                        ws.write_row(r%ExcelSink.MAXROWS+1,0,[r]+[self._excelCell(v) for v in row])
+                        r+=1
+                    lastid=rows[-1][0]
+        finally:
+            workbook.close()
+
+
+    def _excelCell(self,v):
+        # stored values as text for xlsxwriter (raw content may be, or be compressed from, bytes)
+        v=_unpack(v) if isinstance(v,bytes) else v
+        return v.decode('utf-8','replace') if isinstance(v,bytes) else v
+
+
+    def exportResults(self,out,columns=None,uidcolumn=None,chunksize=5000,display={'type':'brief','tick':10}):
+        """Writes the scraped data of done (not skipped) tasks to out, a sink or a filename (.csv, .jsonl,
+        .parquet or .xlsx), reading chunksize rows at a time and only the columns asked for, picked out of
+        the stored json by sqlite (compressed rows are decoded here). columns default to the sink's, else to
+        the columns of the last cycle or of the first chunk; uidcolumn: name of a column for the task uid.
+        Progress is printed every display['tick'] chunks. Returns the number of rows written.
+        """
+        sink=openSink(out) if isinstance(out,str) else out
+        columns=list(sink.columns or columns or self.tc_columns or self._resultColumns(chunksize))
+        if uidcolumn and uidcolumn in columns:
+            columns.remove(uidcolumn)
+        if sink.columns is None:
+            sink.columns=([uidcolumn] if uidcolumn else [])+columns
+            sink._start()
+        self.flush()
+
+        total=self.cursor.execute('''SELECT COUNT(*) FROM scrapedata WHERE content IS NOT NULL AND NOT COALESCE(skip,0);''').fetchone()[0]
+        ti=self.tick(display=False,newcycle=True,currenttime=True)
+        print()
+        print('## exportResults begins -',total,'rows,',len(columns),'columns >',getattr(sink,'filename',''),'-',ti,sep=' ')
+        print('##')
+
+        n,chunks=0,0
+        try:
+            for rows in self._resultChunks(columns,chunksize,getattr(sink,'nested',False)):
+                if not uidcolumn:
+                    rows=[r[1:] for r in rows]
+                sink.writeRows(rows)
+                n+=len(rows)
+                chunks+=1
+                if display['type']!='none' and display.get('tick') and chunks%display['tick']==0:
+                    print(str(n)+'['+str(int(float(n)/total*100))+'%]('+self.tick()+')',end=' ')
+        finally:
+            if isinstance(out,str):
+                sink.close()
+        if display['type']!='none' and display.get('tick'):
+            print()
+        print('##\n## exportResults complete -',n,'rows -',self.tick(total=True,currenttime=True),sep=' ')
+        return n
+
+
+    def _resultColumns(self,chunksize):
+        # keys of the scraped data in the first chunk of results, in order of appearance
+        cols=collections.OrderedDict()
+        for uid,content in self.cursor.execute('''SELECT scrape_task_uid,content FROM scrapedata
+                                                  WHERE content IS NOT NULL AND NOT COALESCE(skip,0) ORDER BY id LIMIT ?;''',(chunksize,)):
+            d=json.loads(_unpack(content))
+            for k in (d if isinstance(d,dict) else {}):
+                cols[k]=None
+        return list(cols)
+
+
+    def _resultChunks(self,columns,chunksize,nested=False):
+        """Yields lists of [uid]+values of columns, chunksize done tasks at a time (keyset paging on id).
+        Values come from json_extract where sqlite can read the content, else from json.loads.
+        nested=True: lists/dicts as python objects rather than json text (always decoded here then).
+        """
+        sqljson=not nested and self._hasJson() and not [c for c in columns if '"' in c]
+        extract=''.join(''',CASE WHEN typeof(content)='text' THEN json_extract(content,?) END''' for c in columns) if sqljson else ''
+        paths=['$."'+c+'"' for c in columns] if sqljson else []
+        lastid=0
+        while True:
+            rows=self.cursor.execute('''SELECT id,scrape_task_uid,'''+('''CASE WHEN typeof(content)!='text' THEN content END''' if sqljson else 'content')+extract+'''
+                                        FROM scrapedata WHERE id>? AND content IS NOT NULL AND NOT COALESCE(skip,0)
+                                        ORDER BY id LIMIT ?;''',paths+[lastid,chunksize]).fetchall()
+            if not rows:
+                break
+            out=[]
+            for r in rows:
+                if r[2] is None:
+                    out.append([r[1]]+list(r[3:]))
+                else:
+                    d=json.loads(_unpack(r[2]))
+                    d=d if isinstance(d,dict) else {}
+                    out.append([r[1]]+[d.get(c) if nested else _cell(d.get(c)) for c in columns])
+            lastid=rows[-1][0]
+            yield out
+
+
+    def _hasJson(self):
+        # whether sqlite was built with the json functions
+        try:
+            self.cursor.execute('''SELECT json_extract('{}','$');''')
+            return True
+        except sqlite3.OperationalError:
+            return False
+
 
-        writer = pd.ExcelWriter(filename, engine='xlsxwriter')
 
-        for ddd in ['scrapedata','variables']:
-            data = pd.read_sql("SELECT * FROM "+ddd+";",self.db)
-            data.to_excel(writer,sheet_name=self.task_name+ddd)
 
-        writer.save()
+    ##
+    ##  QUEUE
+    ##
+    def queue(self,maxattempts=5):
+        """The task's SqliteQueue (made on first call), its table kept in the task db.
+        """
+        if self._queue is None:
+            self.flush()
+            self._queue=SqliteQueue(self.task_name+'-db.sqlite',self.storage.get('compress'),maxattempts)
+        return self._queue
+
+
+    def taskQueue(self,queue=None,iterr=None,checktodo=False,version=None):
+        """Puts tasks in a queue (named after the cycle by default) for queueCycle workers: the elements of iterr
+        for a gather (the ones that are tasks already left out with checktodo), or with iterr=None the tasks
+        a scrape cycle (with version) would do. Failed queue items are put back, and for a scrape done ones too
+        (they are only pending again if their page changed or the version differs). Returns how many were queued.
+        """
+        self.flush()
+        if iterr is None:
+            queue=queue or 'scrapeTask'
+            n=self.queue().put(queue,list(self.selectTasks('pending',version=version)),reset=(2,3))
+        else:
+            queue=queue or 'gatherTask'
+            n=self.queue().put(queue,self.newTasks(iterr) if checktodo else iterr)
+        st=self.queue().stats(queue)
+        print('##',n,'tasks queued >',queue,'-',', '.join(str(st[s])+' '+s for s in QUEUE_STATES),sep=' ')
+        return n
+
+
+    def serveQueue(self,host='127.0.0.1',port=8765,token=None):
+        """Serves the task's queue to HttpQueue workers from a background thread, returns the QueueServer.
+        For workers on other hosts bind it to their network (e.g. host='0.0.0.0') with a token.
+        """
+        srv=QueueServer(self.queue(),host,port,token)
+        print('## Serving queue on','http://'+str(srv.address[0])+':'+str(srv.address[1]),sep=' ')
+        return srv
+
+
+    def queueCycle(self,algofunct,queue=None,name=None,batch=20,lease=120,display={'type':'verbose','freq':1,'tick':0},
+                   unfold='',worker=None,version=None,poll=5):
+        """Task cycle as one of any number of workers sharing a queue filled by taskQueue: batches of tasks
+        are claimed with a lease (renewed while they're worked on) and the results merged into scrapedata
+        by the queue, until none are pending or leased to others. queue is the task's SqliteQueue by default
+        (processes on this host), or an HttpQueue of a serveQueue() elsewhere. Returns the rows scraped here.
+        """
+
+        # Cycle start
+        self._versionResult()
+        ti=self.tick(display=False,newcycle=True,currenttime=True)
+        q=queue if queue is not None else self.queue()
+        name=name or algofunct.__name__
+        worker=worker or socket.gethostname()+'-'+str(os.getpid())
+        scrape=algofunct.__name__=='scrapeTask'
+        print()
+        if 'name' in display.keys() and display['name']:
+            print('## <[',display['name'],']>',sep=' ')
+        print('##',algofunct.__name__,' queue cycle begins -',name,'-',q.stats(name)['pending'],'pending -',worker,'-',ti,sep=' ')
+        print('##')
+
+        self.tc_ndone,self.tc_nwasdone,self.tc_nskipped,self.tc_nnodata=0,0,0,0
+        self.tc_disptype=display['type']
+        self.tc_version=None if version is None else str(version)
+        self.tc_columns=collections.OrderedDict()
+        self.metrics=CycleMetrics(algofunct.__name__,self.currenttimestamp)
+        data=[]
+        held=[]
+        stop=threading.Event()
+
+        def beat():
+            # keeps the leases of the batch being worked on, a failed heartbeat just lets them lapse
+            while not stop.wait(lease/3.):
+                try:
+                    if held:
+                        q.heartbeat(name,worker,list(held),lease)
+                except Exception:
+                    pass
+
+        def prompt(n,it,pr):
+            self.metrics.elements+=1
+            if display['type']!='none' and (display['freq']==1 or (n+1)%display['freq']==0):
+                if display['type']=='verbose':
+                    print(n+1,it,pr,sep=' ',end=' ')
+                elif display['type']=='brief':
+                    print(pr,end=' ')
+            if display['tick']!=0 and n%display['tick']==display['tick']-1:
+                st=q.stats(name)
+                perc='['+str(int(float(st['done'])/max(1,sum(st.values()))*100))+'%]' # of the whole queue
+                if display['type']=='verbose':
+                    print('##',self.tick()+' '+perc+self.metrics.pageLatency(),sep=' ',end=' ')
+                elif display['type']=='brief':
+                    print(str(n+1)+perc+'('+self.tick()+')'+self.metrics.pageLatency(),end=' ')
+
+        hb=threading.Thread(target=beat)
+        hb.daemon=True
+        hb.start()
+        # addTask calls in gatherTask come back as _DeferredTask, and go to the queue with the batch
+        self._queueing=True
+        n=0
+        try:
+            while True:
+                # the queue writes on a connection of its own, so nothing may be left uncommitted on this one
+                self.flush()
+                claimed=q.claim(name,worker,batch,lease,raw=scrape)
+                if not claimed:
+                    st=q.stats(name)
+                    if not st['pending'] and not st['leased']:
+                        break
+                    # the rest is leased to other workers, picked up here if their leases lapse
+                    time.sleep(poll)
+                    continue
+                held[:]=[c[0] for c in claimed]
+                results,prompts,rows=[],{},{}
+                for it,ctype,raw,rawhash in claimed:
+                    if scrape:
+                        _PREFETCHED[(self.dbpath,it)]=(ctype,raw)
+                        try:
+                            dii,sec=_timedCall(algofunct,it)
+                        finally:
+                            _PREFETCHED.pop((self.dbpath,it),None)
+                        self.metrics.task(sec)
+                        if dii:
+                            rows[it]=dii
+                            results.append([it,'data',[dii,rawhash,self.tc_version]])
+                            continue
+                    else:
+                        pr,sec=_timedCall(algofunct,it)
+                        self.metrics.task(sec,_host(it))
+                        if isinstance(pr,_DeferredTask) and pr.uid and not pr.testing:
+                            results.append([it,'task',[pr.uid,pr.ctype,pr.content,pr.update]+list(self._validators.pop(pr.uid,(None,None)))])
+                            self._bytesOut(pr.content)
+                            continue
+                        prompts[it]=self.tc_nodata() if isinstance(pr,_DeferredTask) else pr
+                    results.append([it,None,None])
+                self.flush()
+                outcome=q.complete(name,worker,results)
+                held[:]=[]
+
+                for it,_,_,_ in claimed:
+                    o=outcome.get(it)
+                    if it in prompts:
+                        pr=prompts[it]
+                    elif o=='done':
+                        for d in (self.tc_unfold(rows[it],unfold) if unfold and it in rows else [rows.get(it)]):
+                            if d:
+                                for k in d:
+                                    if k not in self.tc_columns:
+                                        self.tc_columns[k]=None
+                                data.append(d)
+                        pr=self.tc_done()
+                    elif o=='wasdone':
+                        pr=self.tc_wasdone()
+                    elif o=='nodata':
+                        pr=self.tc_nodata()
+                    else:
+                        pr=self.tc_skipped('(lease lost)')
+                    prompt(n,it,pr)
+                    n+=1
+        finally:
+            stop.set()
+            self._queueing=False
+            if held:
+                try:
+                    q.release(name,worker,list(held))
+                except Exception:
+                    pass
+
+        # Cycle end
+        self.tc_version=None
+        self.flush()
+        if display['type']=='brief':
+            print()
+        print('##\n##',algofunct.__name__,'queue cycle complete -',sep=' ',end=' ')
+        stats='t'+str(n)
+        if self.tc_nwasdone:
+            stats+='/='+str(self.tc_nwasdone)
+        if self.tc_ndone:
+            stats+='/+'+str(self.tc_ndone)
+        if self.tc_nskipped:
+            stats+='/s'+str(self.tc_nskipped)
+        if self.tc_nnodata:
+            stats+='/x'+str(self.tc_nnodata)
+        print(stats,'-',self.tick(total=True, currenttime=True),sep=' ')
+        self._saveMetrics()
+        self.flush() # other workers share the db
+        if self.tc_columns:
+            print('## Available columns:', list(self.tc_columns),sep=' ')
+        return data
 
 
 
@@ -447,11 +2432,50 @@ class Scrape_Db():
     ##  TOOLS
     ##
     def removeBlocks(self,lxmlhtml,blockstoremove=[['<!--', '-->'],['<script', '</script>'],['<style', '</style>']]):
-        ht=html.tostring(lxmlhtml)
+        """Returns a copy of the page without the given blocks (comments, script and style by default).
+        Comments and ['<tag', '</tag>'] pairs are stripped from the tree itself, any other pair
+        is cut out of the markup in a single pass, which is then parsed again.
+        """
+        tags,comments,other=[],False,[]
         for blk in blockstoremove:
-            while blk[0] in ht and blk[1] in ht and blk[1] in ht[ht.index(blk[0]):]:
-                ht=ht[:ht.index(blk[0])]+ht[ht.index(blk[1],ht.index(blk[0]))+len(blk[1]):]
-        return html.fromstring(ht)
+            m=re.match(r'^<([a-zA-Z][\w-]*)$',blk[0])
+            if blk[0]=='<!--' and blk[1]=='-->':
+                comments=True
+            elif m and blk[1].lower()=='</'+m.group(1).lower()+'>':
+                tags.append(m.group(1).lower())
+            else:
+                other.append(blk)
+
+        if other:
+            ht=html.tostring(lxmlhtml)
+            for blk in other:
+                ht=self._cutBlocks(ht,blk[0].encode('utf-8'),blk[1].encode('utf-8'))
+            tree=html.fromstring(ht)
+        else:
+            tree=copy.deepcopy(lxmlhtml)
+            if hasattr(tree,'getroot'):
+                tree=tree.getroot()
+
+        if comments:
+            etree.strip_elements(tree,etree.Comment,with_tail=False)
+        if tags:
+            etree.strip_elements(tree,*tags,with_tail=False)
+        return tree
+
+
+    def _cutBlocks(self,ht,start,end):
+        # drops every start...end stretch of ht in one pass
+        out=[]
+        pos=0
+        while True:
+            i=ht.find(start,pos)
+            j=ht.find(end,i+len(start)) if i!=-1 else -1
+            if j==-1:
+                break
+            out.append(ht[pos:i])
+            pos=j+len(end)
+        out.append(ht[pos:])
+        return b''.join(out)
 
         
     def getLDjson(self,lxmlhtml):
@@ -460,20 +2484,15 @@ class Scrape_Db():
 
 
     def getContactFromText(self,text,what,context=0):
-        whatd={'email':RE_EMAIL,'phone':RE_PHONE}
-        text=str(text)
-        try:
-            cd=[x.strip('.- ') for x in set(re.findall(whatd[what],unicode(text)))]
-        except:
-            cd=[x.strip('.- ') for x in set(re.findall(whatd[what],str(text)))]
-        if cd and context>0:
-            r=[]
-            for c in cd:
-                p=text.index(c)
-                r.append([c, text[p-context:p+context].replace('\t','').replace('\n','').replace('\r','')])
-            return r
-        else:
-            return [[c,''] for c in cd]
+        text=text.decode('utf-8','replace') if isinstance(text,bytes) else str(text)
+        r=[]
+        for (kind,c),positions in findContacts(text,(what,)).items():
+            if context>0:
+                p=positions[0]
+                r.append([c, text[max(0,p-context):p+context].replace('\t','').replace('\n','').replace('\r','')])
+            else:
+                r.append([c,''])
+        return r
 
 
     def emailInText(self,text,context=0):
@@ -482,21 +2501,48 @@ class Scrape_Db():
 
 
     def routineFindings(self,lxmlhtml,what=['ldjson','email','phone'],context=100,exclusionlist=[]):
+        return self._routineFindings(lxmlhtml,what,context,'\x00'.join(exclusionlist))
+
+
+    def _routineFindings(self,lxmlhtml,what,context,excl,text=None,markup=None,ldjson=None):
+        # excl is the exclusion list joined by \x00, a finding is excluded if it's part of any entry
+        # text, markup and ldjson of the page can be passed in when they're at hand already
         findings=[]
-        ishtmlelement=isinstance(lxmlhtml,type(html.fromstring('<div></div>')))
+        seen=set()
+        if hasattr(lxmlhtml,'getroot'):
+            lxmlhtml=lxmlhtml.getroot()
+        ishtmlelement=isinstance(lxmlhtml,html.HtmlElement)
         if 'ldjson' in what and ishtmlelement:
-            f=self.getLDjson(lxmlhtml)
+            f=self.getLDjson(lxmlhtml) if ldjson is None else ldjson
             if f:
                 findings.append({'detail':f,'context':'ld+json'})
-        for wh in [w for w in what if w in ['email','phone']]:
-            fi=self.getContactFromText('|'.join([x for x in lxmlhtml.itertext()]) if ishtmlelement else lxmlhtml,wh,context)
-            if wh=='email' and ishtmlelement:
-                fi+=self.getContactFromText(html.tostring(lxmlhtml),'email',context)
-            if fi:
-                for n,f in enumerate(fi):
+                seen.add(f)
+
+        kinds=[w for w in what if w in ['email','phone']]
+        if not kinds:
+            return [x['detail'] for x in findings if x['detail']] if context==0 else findings
+        if text is not None:
+            pass
+        elif ishtmlelement:
+            text='|'.join(lxmlhtml.itertext())
+        else:
+            text=lxmlhtml.decode('utf-8','replace') if isinstance(lxmlhtml,bytes) else str(lxmlhtml)
+        sources=[(text,findContacts(text,kinds))]
+        if 'email' in kinds and ishtmlelement:
+            # emails hidden in the markup (mailto: links and such)
+            if markup is None:
+                markup=html.tostring(lxmlhtml,encoding='unicode')
+            sources.append((markup,findContacts(markup,('email',))))
+
+        for wh in kinds:
+            for src,found in sources:
+                for (kind,c),positions in found.items():
                     # check if already in findings or if on the exclusion list
-                    if not [x for x in findings if x['detail']==f[0]] and not [x for x in exclusionlist if f[0] in x]:
-                        findings.append({'detail':f[0],'context':f[1]})
+                    if kind!=wh or c in seen or (excl and c in excl):
+                        continue
+                    seen.add(c)
+                    p=positions[0]
+                    findings.append({'detail':c,'context':src[max(0,p-context):p+context].replace('\t','').replace('\n','').replace('\r','') if context>0 else ''})
         if context==0:
             return [x['detail'] for x in findings if x['detail']]
         else:
@@ -540,52 +2586,177 @@ class Scrape_Db():
         return proxies
 
 
-    def _requests_with_rotating_proxies(self, url, method='get', headers={}, data={}, timeout=20):
+    def _session(self,proxied=False):
+        """Shared requests session with pooled keep-alive connections, set up from self.http on first use.
+        Retries 429/5xx with backoff (honouring Retry-After); proxied ones don't retry failed connections,
+        a dead proxy is dealt with by rotating.
+        """
+        if proxied not in self._sessions:
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry=Retry(total=self.http['retries'],connect=0 if proxied else self.http['retries'],read=0 if proxied else None,
+                        status_forcelist=RETRY_STATUSES,backoff_factor=self.http['backoff'],
+                        respect_retry_after_header=True,raise_on_status=False)
+            s=requests.Session()
+            adapter=HTTPAdapter(pool_connections=self.http['poolsize'],pool_maxsize=self.http['poolsize'],max_retries=retry)
+            s.mount('http://',adapter)
+            s.mount('https://',adapter)
+            s.headers.update(self.http['headers'])
+            self._sessions[proxied]=s
+        return self._sessions[proxied]
+
+
+    def fetch(self,url,method='get',headers={},data={},timeout=None,conditional=False,proxies=None):
+        """Requests url through the shared session.
+        conditional=True sends the ETag/Last-Modified stored with the task of the same uid, an unchanged page
+        then comes back as a 304 with no body. Validators of its 200s are kept and saved by the next addTask of url
+        (other fetches, e.g. of listing pages, don't record any).
+        """
+        headers=dict(headers)
+        if conditional:
+            v=self._readCursor().execute('''SELECT http_etag,http_lastmodified FROM scrapedata WHERE scrape_task_uid=?;''',
+                                         (url,)).fetchone()
+            if v and v[0]:
+                headers['If-None-Match']=v[0]
+            if v and v[1]:
+                headers['If-Modified-Since']=v[1]
+        params={'timeout':timeout or self.http['timeout'],'headers':headers}
+        if data:
+            params['data']=data
+        if proxies:
+            params['proxies']=proxies
+        r=self._session(proxied=bool(proxies)).request(method.upper(),url,**params)
+        if self.metrics is not None and self.metrics.ended is None:
+            self.metrics.add('bytesin',len(r.content))
+        if self.scheduler is not None:
+            # throttling answers retried by the session count too
+            h=_host(url)
+            for x in getattr(getattr(r.raw,'retries',None),'history',()) or ():
+                self.scheduler.observe(h,x.status)
+            ra=r.headers.get('Retry-After','')
+            self.scheduler.observe(h,r.status_code,float(ra) if ra.isdigit() else None)
+        if conditional and r.status_code==200 and (r.headers.get('ETag') or r.headers.get('Last-Modified')):
+            self._validators[url]=(r.headers.get('ETag'),r.headers.get('Last-Modified'))
+        return r
+
+
+    def proxyPool(self):
+        """The task's ProxyPool, restored from the variables table on first use.
+        """
+        with self._proxylock:
+            if self._proxypool is None:
+                pool=ProxyPool()
+                if threading.current_thread() is self._owner:
+                    pool.load(self.getVariable('scrrryProxyPool',{}))
+                else:
+                    saved=self._readCursor().execute('''SELECT variable_content FROM variables WHERE variable_name=?;''',
+                                                     ('scrrryProxyPool',)).fetchone()
+                    if saved:
+                        pool.load(json.loads(saved[0]))
+                self._proxypool=pool
+        return self._proxypool
+
+
+    def loadProxies(self,path,validate=True):
+        """Adds proxies listed in a file (ip:port per line) to the pool, optionally checking them straight away.
+        """
+        new=self.proxyPool().loadFile(path)
+        if validate:
+            self.proxyPool().validate(new,fetch=lambda url,proxies: self.fetch(url,proxies=proxies,timeout=self.proxyPool().timeout))
+        self.saveProxyPool()
+        return new
+
+
+    def _robotsCache(self):
+        # host -> [crawl-delay, when looked up], kept in the variables table
+        if self._robots is None:
+            self._robots=self.getVariable('scrrryRobots',{})
+        return self._robots
+
+
+    def _crawlDelay(self,host,scheme='http',ttl=86400):
+        """robots.txt crawl-delay of host (for the session's User-Agent, or *), cached for ttl seconds.
+        Safe to call from worker threads, the cache is updated by _saveCrawlDelay.
+        """
+        c=self._robots.get(host) if self._robots is not None else None
+        if c and time.time()-c[1]<ttl:
+            return c[0]
+        try:
+            r=self._session().get(scheme+'://'+host+'/robots.txt',timeout=self.http['timeout'])
+        except requests.RequestException:
+            return 0
+        if r.status_code!=200:
+            return 0
+        return robotsCrawlDelay(r.text,self.http['headers'].get('User-Agent','*'))
+
+
+    def _saveCrawlDelay(self,host,delay):
+        self._robotsCache()[host]=[delay,time.time()]
+        self.setVariable('scrrryRobots',self._robots)
+        return delay
+
+
+    def saveProxyPool(self):
+        if self._proxypool is not None:
+            self.setVariable('scrrryProxyPool',self._proxypool.state())
+
+
+    def _refill_proxies(self):
+        pool=self.proxyPool()
+        new=pool.add(self._get_proxies())
+        print('## ... checking',len(new),'new proxies',sep=' ',end=' ')
+        print(len(pool.validate(new,fetch=lambda url,proxies: self.fetch(url,proxies=proxies,timeout=pool.timeout))),'ok')
+
+
+    def _requests_with_rotating_proxies(self, url, method='get', headers={}, data={}, timeout=20, attempts=30):
         params={'timeout':timeout}
         if headers:
             params['headers']=headers
         if data:
             params['data']=data
 
+        pool=self.proxyPool()
         no_of_proxy_setups = 0
-        while True:
-            if not self.proxylist:
-                self.proxylist = self._get_proxies()
-                self.proxypos = 0
+        r=None
+        for _ in range(attempts):
+            addr=pool.pick()
+            if addr is None:
+                # refill from the web once per call at most, one thread at a time
+                if no_of_proxy_setups:
+                    break
+                with self._proxylock:
+                    if pool.pick() is None:
+                        self._refill_proxies()
                 no_of_proxy_setups += 1
+                continue
+            params['proxies']={'http':'http://'+addr,'https':'http://'+addr}
+            t=time.time()
             try:
-                params['proxies']={
-                    'http':'http://'+self.proxylist[self.proxypos]['ip']+':'+self.proxylist[self.proxypos]['port'],
-                    'https':'http://'+self.proxylist[self.proxypos]['ip']+':'+self.proxylist[self.proxypos]['port'],
-                }
-
                 if method=='get':
-                    r=requests.get(url, **params)
+                    r=self.fetch(url, **params)
                 elif method=='post':
-                    r=requests.post(url, **params)
+                    r=self.fetch(url, method='post', **params)
                     print('post',r.status_code)
-
-                if r and r.status_code==200:
-                    break
-                elif r and r.status_code==404:
-                    print('!404!',url)
-                    return None
-                elif r and r.status_code == 500:
-                    print('!500!',url)
-                    return None
-
-                self.proxypos = (self.proxypos + 1) % len(self.proxylist)
-            except:
+            except Exception:
                 r=None
-                self.proxylist.pop(self.proxypos)
-                if self.proxylist and len(self.proxylist) == self.proxypos:
-                    self.proxypos = 0
+                pool.report(addr,False)
                 print('.',end=' ')
-            
-            if not self.proxylist and no_of_proxy_setups > 1:
-                r=None
+                continue
+
+            if r.status_code==200:
+                pool.report(addr,True,time.time()-t)
                 break
-        
+            elif r.status_code==404:
+                pool.report(addr,True,time.time()-t)
+                print('!404!',url)
+                return None
+            elif r.status_code == 500:
+                pool.report(addr,True,time.time()-t)
+                print('!500!',url)
+                return None
+            pool.report(addr,False)
+            r=None
+
         return r
 
 
@@ -600,24 +2771,145 @@ class Scrape_Db():
     ##
     ##  GATHERING
     ##
-    def addTask(self,uid,ctype='url',content='',testing=False,standalone=False):
+    def addTask(self,uid,ctype='url',content='',testing=False,standalone=False,update=False):
         """Adds task and optional content to the scraping todo list.
+        update=True rewrites type and content of a task that exists already (e.g. a re-gathered page),
+        unless they are the same as stored.
         """
-        if testing:
+        if self._queueing or self._offWriter():
+            return _DeferredTask(uid,ctype,content,testing,update)
+        elif testing:
             return self.tc_nodata(standalone=standalone)
-        elif self.cursor.execute('''SELECT id FROM scrapedata WHERE scrape_task_uid=?;''',(uid,)).fetchone():
-            return self.tc_wasdone(standalone=standalone)
+        t0=time.time()
+        validators=self._validators.pop(uid,(None,None))
+        rawhash=_rawHash(content)
+        existing=self.cursor.execute('''SELECT raw_hash,scrape_task_type FROM scrapedata WHERE scrape_task_uid=?;''',(uid,)).fetchone()
+        if existing:
+            if not update:
+                return self.tc_wasdone(standalone=standalone)
+            oldhash=existing[0] or _rawHash(self.rawContent(uid))
+            if oldhash==rawhash and existing[1]==ctype:
+                # same page as before, only the validators are refreshed
+                if validators!=(None,None):
+                    self.cursor.execute('''UPDATE scrapedata SET http_etag=COALESCE(?,http_etag),http_lastmodified=COALESCE(?,http_lastmodified)
+                                        WHERE scrape_task_uid=?;''', validators+(uid,))
+                    self._commit()
+                self._dbTime(t0)
+                return self.tc_wasdone(standalone=standalone)
+            packed=_pack(content,self.storage.get('compress'))
+            self.cursor.execute('''UPDATE scrapedata SET scrape_task_type=?,scrape_task_content=?,raw_hash=?,
+                                http_etag=COALESCE(?,http_etag),http_lastmodified=COALESCE(?,http_lastmodified)
+                                WHERE scrape_task_uid=?;''', (ctype,packed,rawhash)+validators+(uid,))
+            self._commit()
+            self._dbTime(t0)
+            self._bytesOut(packed)
+            return self.tc_done(standalone=standalone)
         elif uid:
-            self.cursor.execute('''INSERT INTO scrapedata(added_date,scrape_task_uid,scrape_task_type,scrape_task_content,skip)
-                                VALUES (?,?,?,?,?);''', (datetime.datetime.now(),uid,ctype,content,False))
-            self.db.commit()
+            packed=_pack(content,self.storage.get('compress'))
+            self.cursor.execute('''INSERT INTO scrapedata(added_date,scrape_task_uid,scrape_task_type,scrape_task_content,skip,
+                                raw_hash,http_etag,http_lastmodified)
+                                VALUES (?,?,?,?,?,?,?,?);''', (datetime.datetime.now(),uid,ctype,packed,False,rawhash)+validators)
+            self._commit()
+            self._dbTime(t0)
+            self._bytesOut(packed)
+            if self.tc_known is not None:
+                self.tc_known.add(uid)
             return self.tc_done(standalone=standalone)
 
 
+    def addTasks(self,tasks,update=False,batch=50000,feedback=True):
+        """Adds tasks from an iterable of (uid, ctype, content) (or plain uids, as url tasks) in one transaction
+        per batch, the ones that are tasks already (or repeats) left out in SQL rather than one lookup each.
+        update=True rewrites type and content of existing tasks whose raw content differs, as addTask does.
+        Prints and returns the counts (done, was already done) as a task cycle would.
+        """
+        t0=time.time()
+        compress=self.storage.get('compress')
+        ndone,nwasdone,n=0,0,0
+        tasks=iter(tasks)
+        if feedback:
+            print('## ... Adding tasks >',end=' ')
+        self.flush()
+        self.cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS newtasks( uid TEXT PRIMARY KEY, ctype TEXT, content TEXT, rawhash TEXT);''')
+        while True:
+            rows=[]
+            for t in itertools.islice(tasks,batch):
+                t=(t,) if isinstance(t,str) else tuple(t)
+                content=t[2] if len(t)>2 else ''
+                if t[0]:
+                    rows.append((t[0],t[1] if len(t)>1 else 'url',_pack(content,compress),_rawHash(content)))
+            if not rows:
+                break
+            try:
+                self.cursor.execute('''DELETE FROM temp.newtasks;''')
+                # first of any repeats in the batch is kept
+                self.cursor.executemany('''INSERT OR IGNORE INTO temp.newtasks(uid,ctype,content,rawhash) VALUES (?,?,?,?);''',rows)
+                added=0
+                if update:
+                    self.cursor.execute('''UPDATE scrapedata SET
+                                        scrape_task_type=(SELECT ctype FROM temp.newtasks WHERE uid=scrape_task_uid),
+                                        scrape_task_content=(SELECT content FROM temp.newtasks WHERE uid=scrape_task_uid),
+                                        raw_hash=(SELECT rawhash FROM temp.newtasks WHERE uid=scrape_task_uid)
+                                        WHERE scrape_task_uid IN (SELECT uid FROM temp.newtasks) AND
+                                        (raw_hash IS NOT (SELECT rawhash FROM temp.newtasks WHERE uid=scrape_task_uid) OR
+                                         scrape_task_type IS NOT (SELECT ctype FROM temp.newtasks WHERE uid=scrape_task_uid));''')
+                    added=self.cursor.rowcount
+                self.cursor.execute('''INSERT INTO scrapedata(added_date,scrape_task_uid,scrape_task_type,scrape_task_content,skip,raw_hash)
+                                    SELECT ?,uid,ctype,content,0,rawhash FROM temp.newtasks
+                                    WHERE uid NOT IN (SELECT scrape_task_uid FROM scrapedata WHERE scrape_task_uid IS NOT NULL)
+                                    ORDER BY rowid;''',(datetime.datetime.now(),))
+                added+=self.cursor.rowcount
+                self.db.commit()
+            except Exception as e:
+                self.db.rollback()
+                raise e
+            if self.tc_known is not None:
+                self.tc_known.update(r[0] for r in rows)
+            for r in rows:
+                self._bytesOut(r[2])
+            n+=len(rows)
+            ndone+=added
+            nwasdone+=len(rows)-added
+            if feedback:
+                print(n,end=' ')
+        self.cursor.execute('''DELETE FROM temp.newtasks;''')
+        self._dbTime(t0)
+        if feedback:
+            t=time.time()-t0
+            stats='t'+str(n)
+            if nwasdone:
+                stats+='/='+str(nwasdone)
+            if ndone:
+                stats+='/+'+str(ndone)
+            print('Done.')
+            print('##',stats,'-',"%ih %im %.2fs" % (int(t/3600),int(t/60)%60,t%60),'- %.1f tasks/s' % (n/t if t else 0),sep=' ')
+        return ndone,nwasdone
+
+
+    def _bytesOut(self,val):
+        if self.metrics is not None and self.metrics.ended is None and isinstance(val,(str,bytes,memoryview)):
+            self.metrics.add('bytesout',len(val))
+
+
+    def newTasks(self,iterr):
+        """Returns the elements of iterr that aren't tasks yet, in one pass (order kept, repeats dropped).
+        """
+        known=self.tc_known if self.tc_known is not None else set(self.toDo())
+        seen=set()
+        new=[]
+        for it in iterr:
+            if it not in known and it not in seen:
+                seen.add(it)
+                new.append(it)
+        return new
+
+
     def removeTask(self,uid,feedback=True):
         if self.cursor.execute('''SELECT id FROM scrapedata WHERE scrape_task_uid=?;''',(uid,)).fetchone():
             self.cursor.execute('''DELETE FROM scrapedata WHERE scrape_task_uid=?;''',(uid,)).fetchone()
-            self.db.commit()
+            self._commit()
+            if self.tc_known is not None:
+                self.tc_known.discard(uid)
             if feedback:
                 print('## '+uid+' REMOVED')
         else:
@@ -634,47 +2926,184 @@ class Scrape_Db():
         """Switch whether a task should be skipped.
         """
         self.cursor.execute('UPDATE scrapedata SET skip=? WHERE scrape_task_uid=?;', (boo,uid))
-        self.db.commit()
+        self._commit()
 
     def istoDo(self,uid):
         """Checks if task is to be skipped and if it was done or not and returns date string or an empty one if not done yet.
         """
-        wasdoneorskip=self.cursor.execute('''SELECT scrape_date,skip FROM scrapedata WHERE scrape_task_uid=?;''',(uid,)).fetchone()
-        #print wasdoneorskip
-        if bool(wasdoneorskip[1]):
+        wasdoneorskip=self.cursor.execute('''SELECT skip,scrape_date FROM scrapedata WHERE scrape_task_uid=?;''',(uid,)).fetchone()
+        return self._state(*wasdoneorskip)
+
+    def _state(self,skip,scrape_date):
+        # 'SKIP', date the task was done or '' (see istoDo)
+        if bool(skip):
             return 'SKIP'
         else:
-            if wasdoneorskip[0]:
-                return wasdoneorskip[0].split(' ')[0]
+            if scrape_date:
+                return scrape_date.split(' ')[0]
             else:
                 return ''
 
+    def _doneDateSql(self,version=None):
+        # scrape_date, or NULL where the result is out of date: raw content changed since, or another scrapeTask version
+        # (no version matches any), as sql and its parameters
+        return ('CASE WHEN raw_hash IS NOT scrape_raw_hash OR scrape_version IS NOT COALESCE(?,scrape_version) THEN NULL ELSE scrape_date END',
+                [None if version is None else str(version)])
+
+    def changedTasks(self,version=None):
+        """Returns list of done tasks the next scrape cycle (with version) would redo.
+        """
+        donedate,params=self._doneDateSql(version)
+        return [x[0] for x in self.cursor.execute('''SELECT scrape_task_uid FROM scrapedata
+                                    WHERE scrape_date IS NOT NULL AND '''+donedate+''' IS NULL;''',params).fetchall()]
+
+    def _taskRows(self,uids,raw=True,pagesize=500):
+        """Yields (uid, (skip, scrape_date, type, raw content, content)) for uids with one SELECT per page,
+        raw content only for tasks that aren't done (and not at all with raw=False), None for unknown uids.
+        Out of date results (see _doneDateSql) count as not done.
+        """
+        uids=iter(uids)
+        donedate,params=self._doneDateSql(self.tc_version)
+        while True:
+            page=list(itertools.islice(uids,pagesize))
+            if not page:
+                break
+            t0=time.time()
+            query=lambda page: {x[0]:x[1:] for x in self.cursor.execute('''SELECT scrape_task_uid,skip,'''+donedate+''',scrape_task_type,
+                                    '''+('CASE WHEN '+donedate+' IS NULL THEN scrape_task_content END' if raw else 'NULL')+''',content
+                                    FROM scrapedata WHERE scrape_task_uid IN ('''+','.join('?'*len(page))+''')
+                                    ORDER BY scrape_task_uid;''',params*(2 if raw else 1)+page).fetchall()}
+            rows=query(page)
+            self._dbTime(t0)
+            handled=set()
+            for uid in page:
+                if uid in handled:
+                    # a repeat, the row as it is now that the first one's been dealt with
+                    rows.update(query([uid]))
+                handled.add(uid)
+                yield uid,rows.get(uid)
+
     def content(self,uid):
         """Returns dumped data for given uid in dict format.
         """
-        return json.loads(self.cursor.execute('''SELECT content FROM scrapedata WHERE scrape_task_uid=?;''',(uid,)).fetchone()[0])
+        return json.loads(_unpack(self.cursor.execute('''SELECT content FROM scrapedata WHERE scrape_task_uid=?;''',(uid,)).fetchone()[0]))
 
     def rawContent(self,uid):
         """Returns raw data for given uid.
         """
-        return self.cursor.execute('''SELECT scrape_task_content FROM scrapedata WHERE scrape_task_uid=?;''',(uid,)).fetchone()[0]
+        if (self.dbpath,uid) in _PREFETCHED:
+            return _unpack(_PREFETCHED[(self.dbpath,uid)][1])
+        return _unpack(self.cursor.execute('''SELECT scrape_task_content FROM scrapedata WHERE scrape_task_uid=?;''',(uid,)).fetchone()[0])
+
+    def _rawContentPages(self,uids,pagesize=200):
+        """Yields (uid, type, raw content) for uids, one SELECT per page (uids that aren't tasks are left out).
+        Uses its own read-only connection, so it can be consumed from another thread (e.g. a Pool's task feeder).
+        """
+        try:
+            from urllib.request import pathname2url
+        except ImportError:
+            from urllib import pathname2url
+        db=sqlite3.connect('file:'+pathname2url(os.path.abspath(self.task_name+'-db.sqlite'))+'?mode=ro',uri=True)
+        try:
+            for p in range(0,len(uids),pagesize):
+                page=uids[p:p+pagesize]
+                rows={x[0]:x[1:] for x in db.execute('''SELECT scrape_task_uid,scrape_task_type,scrape_task_content FROM scrapedata
+                                                        WHERE scrape_task_uid IN ('''+','.join('?'*len(page))+''');''',page)}
+                for uid in page:
+                    if uid in rows:
+                        yield (uid,)+rows[uid]
+        finally:
+            db.close()
 
     def parse_content(self,uid):
         return html.fromstring(self.rawContent(uid))
 
+    def _cached(self,uid,what,build):
+        # artifact what of the task's page by build(raw content), kept in PARSE_CACHE if it's on (no hashing otherwise)
+        raw=self.rawContent(uid)
+        if not PARSE_CACHE.maxitems:
+            return build(raw)
+        return PARSE_CACHE.get((self.task_name,uid,_rawHash(raw)),what,lambda: build(raw),lambda v: len(repr(v)))
+
+    def strippedContent(self,uid,blockstoremove=None):
+        """removeBlocks on the task's page (default blocks if None).
+        """
+        return self.removeBlocks(self.parse_content(uid),*(() if blockstoremove is None else (blockstoremove,)))
+
+    def textContent(self,uid,stripped=True):
+        """Text of the task's page, without comment/script/style blocks unless stripped=False, cached (see ParseCache).
+        Text nodes are joined by '|' (as routineFindings sees them).
+        """
+        def build(raw):
+            tree=html.fromstring(raw)
+            return '|'.join((self.removeBlocks(tree) if stripped else tree).itertext())
+        return self._cached(uid,('text',stripped),build)
+
+    def ldjsonContent(self,uid):
+        """getLDjson of the task's page, cached (see ParseCache).
+        """
+        return self._cached(uid,'ldjson',lambda raw: self.getLDjson(html.fromstring(raw)))
+
+    def taskFindings(self,uid,what=['ldjson','email','phone'],context=100,exclusionlist=[]):
+        """routineFindings(removeBlocks(parse_task(uid))), cached (see ParseCache),
+        the ld+json taken from the page before its script blocks are removed.
+        """
+        def build(raw):
+            tree=html.fromstring(raw)
+            ldjson=self.getLDjson(tree) if 'ldjson' in what else None
+            return self._routineFindings(self.removeBlocks(tree),what,context,'\x00'.join(exclusionlist),ldjson=ldjson)
+        found=self._cached(uid,('findings',tuple(what),context,tuple(exclusionlist)),build)
+        return [dict(x) if isinstance(x,dict) else x for x in found]
+
+    def parseCacheStats(self):
+        """Hit/miss statistics and size of the parsed page cache (shared by all Scrape_Db in the process).
+        """
+        return PARSE_CACHE.stats()
+
 
 
     def toDo(self):
-        """Returns list of ALL tasks.
+        """Returns list of ALL tasks (see selectTasks for subsets, read as needed).
         """
         return [x[0] for x in self.cursor.execute('''SELECT scrape_task_uid FROM scrapedata;''').fetchall()]
 
+    def selectTasks(self,state='all',before=None,ctype=None,sample=None,limit=None,after=0,version=None,pagesize=1000):
+        """TaskSelection of tasks in state ('all', 'pending': neither skipped nor done, 'done' or 'skipped'),
+        with before (date/datetime or 'YYYY-MM-DD') only the ones done before then, with ctype (or list of them)
+        only tasks of that type, sample=n picks n of them at random, limit caps how many, after starts past that task id
+        (see TaskSelection.page). Done means done with version and since the raw content last changed, as for taskCycle.
+        """
+        if state not in TASK_STATES:
+            raise ValueError('state is one of '+', '.join(TASK_STATES))
+        donedate,doneparams=self._doneDateSql(version)
+        where,params=[],[]
+        if state=='pending':
+            where.append('NOT COALESCE(skip,0) AND '+donedate+' IS NULL')
+            params+=doneparams
+        elif state=='done':
+            where.append('NOT COALESCE(skip,0) AND '+donedate+' IS NOT NULL')
+            params+=doneparams
+        elif state=='skipped':
+            where.append('COALESCE(skip,0)')
+        if before is not None:
+            where.append(donedate+'<?')
+            params+=doneparams+[str(before)]
+        if ctype is not None:
+            ctype=[ctype] if isinstance(ctype,str) else list(ctype)
+            where.append('scrape_task_type IN ('+','.join('?'*len(ctype))+')')
+            params+=ctype
+        return TaskSelection(self,' AND '.join(where) or '1',params,limit,sample,after,pagesize)
+
     def done(self,uid,content):
         """Add gathered data dict to an existing task.
         """
-        self.cursor.execute('UPDATE scrapedata SET scrape_date=?,content=? WHERE scrape_task_uid=?;',
-                            (datetime.datetime.now(),json.dumps(content),uid))
-        self.db.commit()
+        t0=time.time()
+        packed=_pack(json.dumps(content),self.storage.get('compress'))
+        self.cursor.execute('''UPDATE scrapedata SET scrape_date=?,content=?,scrape_raw_hash=raw_hash,scrape_version=?
+                            WHERE scrape_task_uid=?;''',(datetime.datetime.now(),packed,self.tc_version,uid))
+        self._commit()
+        self._dbTime(t0)
+        self._bytesOut(packed)
 
 
 
@@ -693,7 +3122,14 @@ class Scrape_Db():
                 if 'noimages' in options:
                     prefs = {"profile.managed_default_content_settings.images":2}
                     chromeOptions.add_experimental_option("prefs",prefs)
-            return webdriver.Chrome(path,chrome_options=chromeOptions)
+                if 'headless' in options:
+                    chromeOptions.add_argument("--headless")
+            try:
+                return webdriver.Chrome(path,chrome_options=chromeOptions)
+            except TypeError:
+                # selenium 4 takes the chromedriver path through a Service
+                from selenium.webdriver.chrome.service import Service
+                return webdriver.Chrome(service=Service(path),options=chromeOptions)
 
         elif driver=='phantomjs':
             service_args=[]
@@ -707,26 +3143,52 @@ class Scrape_Db():
             return False
 
 
-    def selenium_waitfor(self,driver,xpath,visibility=False,scrollto=True,report=False,timeout=20):
-        c=0
-        element=driver.find_elements_by_xpath(xpath)
+    def driverPool(self,driver='chrome',path='',header=[],options=['headless'],size=2,maxpages=50,factory=None):
+        """The task's DriverPool (made on first call) of browsers set up like selenium() does, or by factory().
+        """
+        if self._driverpool is None:
+            self._driverpool=DriverPool(factory or (lambda: self.selenium(driver,path,header,options)),size,maxpages)
+        return self._driverpool
+
+
+    def render(self,url,waitfor=None,visibility=False,timeout=20):
+        """Page source of url loaded in a browser of the driver pool, once the waitfor xpath is there
+        (None if it doesn't show up in timeout seconds). Load times show in the cycle's progress ticks.
+        """
+        with self.driverPool().driver() as d:
+            t=time.time()
+            d.get(url)
+            if waitfor and self.selenium_waitfor(d,waitfor,visibility=visibility,scrollto=False,timeout=timeout) is None:
+                return None
+            if self.metrics is not None and self.metrics.ended is None:
+                self.metrics.page(time.time()-t)
+            return d.page_source
+
+
+    def selenium_waitfor(self,driver,xpath,visibility=False,scrollto=True,report=False,timeout=20,poll=0.1):
+        """First element at xpath once present (and displayed with visibility), polled every poll seconds
+        for up to timeout seconds in all; None if it doesn't get there.
+        """
+        deadline=time.time()+timeout
+        def find():
+            if hasattr(driver,'find_elements_by_xpath'):
+                return driver.find_elements_by_xpath(xpath)
+            return driver.find_elements('xpath',xpath)
+        element=find()
+        if not element and report:
+            print('waiting for',xpath,sep=' ')
         while not element:
-            element=driver.find_elements_by_xpath(xpath)
-            if report:
-                print('waiting for',xpath,sep=' ')
-            time.sleep(1)
-            c+=1
-            if c==timeout:
+            if time.time()>=deadline:
                 return None
-        c=0
-        if visibility:
+            time.sleep(max(0,min(poll,deadline-time.time())))
+            element=find()
+        if visibility and not element[0].is_displayed():
+            if report:
+                print('waiting for visibility of',xpath,sep=' ')
             while not element[0].is_displayed():
-                if report:
-                    print('waiting for visibility of',xpath,sep=' ')
-                time.sleep(1)
-                c+=1
-                if c==timeout:
+                if time.time()>=deadline:
                     return None
+                time.sleep(max(0,min(poll,deadline-time.time())))
         if scrollto:
             driver.execute_script("arguments[0].scrollIntoView();", element[0])
         return element[0]
@@ -734,12 +3196,12 @@ class Scrape_Db():
 
     def parse_page(self,uid):
         """By default parses page first by trying to do it with lxml.thml.parse,
-        then with lxml.html.fromstring(requests.get).
+        then with lxml.html.fromstring(fetch).
         """
         try:
             return html.parse(uid)
         except:
-            return html.fromstring(requests.get(uid).text)
+            return html.fromstring(self.fetch(uid).text)
 
 
     def parse_task(self,uid):
@@ -747,7 +3209,10 @@ class Scrape_Db():
         scrape_task_type is set by ctype param of addTask
         currently supported values are: url, html and json
         """
-        dtype = self.cursor.execute('''SELECT scrape_task_type FROM scrapedata WHERE scrape_task_uid=?;''',(uid,)).fetchone()[0]
+        if (self.dbpath,uid) in _PREFETCHED:
+            dtype = _PREFETCHED[(self.dbpath,uid)][0]
+        else:
+            dtype = self.cursor.execute('''SELECT scrape_task_type FROM scrapedata WHERE scrape_task_uid=?;''',(uid,)).fetchone()[0]
         if dtype=='url':
             return self.parse_page(uid)
         elif dtype=='html':
@@ -5,12 +5,10 @@ from __future__ import print_function
 # (https://raw.githubusercontent.com/DGalbichek/scrrry/79ca2a47b4dec4b9df637a8ee24d7c2dcf8929f5/scrrry.py)
 #
 
-from lxml import html
-
 import os
-import pandas as pd
-import requests
 import scrrry as sc
+# lxml, requests and pandas are imported in the functions that use them,
+# so multi-processing workers (that load this file) only pay for what they run
 
 
 ## init
@@ -20,6 +18,9 @@ TASK_NAME=os.path.basename(__file__).replace('.pyc','').replace('.py','')
 # to prevent them from running when multi-threading
 if __name__ == '__main__':
     scr=sc.Scrape_Db(TASK_NAME)
+    #scr=sc.Scrape_Db(TASK_NAME,storage={'wal':True,'commitevery':500,'commitinterval':5}) # indexed db, grouped commits (!! drops duplicate tasks of an existing db)
+    #                                   ,'compress':'zlib'}) # compressed raw/scraped content, scr.compressStorage() converts an existing db
+    #scr=sc.Scrape_Db(TASK_NAME,storage={'compress':'zlib'}) # compression alone leaves the db as it is otherwise
 else:
     scr=sc.Scrape_Db(TASK_NAME,ver_check=False,multicall=True)
 
@@ -29,10 +30,15 @@ else:
 def gatherTask(it):
     '''This is the algofunct passed in to task cycle management for gathering.
     Has to return scr.addTask()'''
-    
+    from lxml import html
+
     # could do all sorts of things in here, just remember this is for individual tasks
-    #r=requests.get(it) # plain request
-    r=scr.get_with_rotating_proxies(it) # request through proxy
+    #r=sc.requests.get(it) # plain request
+    #r=scr.fetch(it) # pooled keep-alive request with retries on 429/5xx
+    #r=scr.fetch(it,conditional=True) # same, but only downloads if changed since the last gather
+    #if r.status_code==304: return scr.tc_wasdone() # (then addTask(...,update=True) below)
+    #rt=scr.render(it,waitfor='//whatever the xpath is') # js heavy pages: loaded in a pooled browser (scr.driverPool(size=4,maxpages=50) sets it up)
+    r=scr.get_with_rotating_proxies(it) # request through proxy (scored pool, kept in the db; scr.loadProxies('proxies.txt') adds your own)
     rt=r.text.encode(r.encoding)
     print(sc.survey_page(rt))
     hh=html.fromstring(rt)
@@ -44,6 +50,8 @@ def gatherTask(it):
 
 ## CYCLE        ##              ##
 def gather():
+    from lxml import html
+    import requests
     h=html.fromstring(requests.get('https://whatever the website is').text)
     iterr=[]
 
@@ -55,10 +63,16 @@ def gather():
         for x in hh.xpath('//whatever the xpath is'):
             iterr.append(x.attrib['href'])
 
+    #iterr=scr.newTasks(iterr) # drop urls that are already tasks in one go
+    #scr.addTasks((u,'url','') for u in open('urls.txt').read().split()) # lots of tasks known up front (sitemap, csv...) added in bulk
+
     # set display options here
     display={'type':'brief','freq':1,'tick':20}
     # and execute the Gather Cycle using the above gatherTask
     scr.taskCycle(gatherTask,iterr,display=display,checktodo=True)
+    #   ,concurrent={'workers':16,'perhost':4}) # this bit enables concurrent gathering (hosts interleaved)
+    #   ,concurrent={'workers':16,'perhost':2,'rate':1,'robots':True}) # politer: 1 request/s per host at most, robots.txt crawl-delay honoured
+    #scr.taskQueue(iterr=iterr) # or share the work out: queue the urls, then scr.queueCycle(gatherTask,display=display) in any number of processes
 
 
 if __name__ == '__main__':
@@ -84,6 +98,7 @@ def scrapeTask(p):
     # some data mining below
     h=scr.removeBlocks(h) # to clear unwanted html blocks (comment, script, style by default)
     em=scr.routineFindings(h,what=['email',],context=0) #look for emails
+    #em=scr.taskFindings(p,what=['email',],context=0) # same, cached if sc.PARSE_CACHE.resize(maxitems=512) is on (pages gone over more than once, see scr.parseCacheStats())
     if em:
         dat['email']='|'.join(em)
 
@@ -96,14 +111,29 @@ if __name__ == '__main__':
     # set display options here
     display={'type':'brief','freq':10,'tick':100}
     iterr='def' # iterate over all tasks
-    #iterr=scr.toDo()[:1000] # iterate over a subset (ordering is based on when tasks were added)
+    #iterr='pending' # only the ones not done or skipped yet (read from the db as the cycle goes)
+    #iterr=scr.selectTasks('pending',limit=1000) # iterate over a subset (ordering is based on when tasks were added)
+    #   ,ctype='html',sample=100) # of a type, a random sample; also 'done'/'skipped', before='2024-01-01' (done before)
 
     #scr.clearAllDone() # this can clear all tasks in case you made some modifications to what you want to extract and need to rerun on all tasks
 
     # execute the Scrape Cycle using the above scrapeTask
     data=scr.taskCycle(scrapeTask,iterr,display=display) # comment this out to toggle on/off
     #   ,nosubmit=True) # extracted data gets saved in the db and will be used on next run instead of being reextracted again
-    #   ,multi={'noofproc':4,'batchsize':200}) # this bit enables multi-threading
+    #   ,multi={'noofproc':4,'chunksize':8}) # this bit enables multi-processing (results come in completion order)
+    #   ,version='2') # bump when scrapeTask changes, done tasks are redone (tasks whose page changed are always redone)
+    #   ,checkpoint={'every':500,'interval':60}) # records progress, an interrupted run picks up where it stopped (see scr.checkpoints())
+
+    # sharing the work between processes/hosts: queue the pending tasks once, then run workers with leases on batches of tasks
+    #scr.taskQueue() # (version=... as for taskCycle)
+    #data=scr.queueCycle(scrapeTask,display=display,batch=20,lease=120) # in as many processes on this host as you like
+    #srv=scr.serveQueue('0.0.0.0',8765,token='secret') # and on other hosts: scr.queueCycle(scrapeTask,sc.HttpQueue('http://thishost:8765',token='secret'))
+
+    # for big jobs rows can be streamed to a file instead of being collected in data
+    #with sc.CsvSink(TASK_NAME+'.csv',['whateverfield','whatever']) as sink: # or JsonLinesSink, ParquetSink, ExcelSink
+    #    scr.taskCycle(scrapeTask,iterr,display=display,sink=sink)
+    #scr.unusedColumns(None,['whateverfield','whatever'])
+    #print(scr.metrics.slowHosts()) # timings of the last cycle (also scr.metrics.json()/.prometheus(), history in scr.metricsHistory())
 
 
 # WRITE TO EXCEL
@@ -111,6 +141,7 @@ if __name__ == '__main__':
 
 # exporting data to a spreadsheet
 def writeexcel():
+    import pandas as pd
     # specify column names you want to be exported (and their order)
     columns=['whateverfield','whatever']
 
@@ -118,10 +149,11 @@ def writeexcel():
     print('\n## ... Writing to Excel spreadsheet > '+ TASK_NAME+'.xlsx',end=' ')
     pd.DataFrame(data, columns=columns).to_excel(TASK_NAME+'.xlsx')
     print('Done.')
+    #scr.exportResults(TASK_NAME+'.xlsx',columns) # for big jobs: straight from the db in chunks, also .csv/.parquet/.jsonl
 
 if __name__ == '__main__':
     writeexcel()
 
     # WRAPUP
     print('\n##\n## Script total runtime: '+scr.tick(scripttotal=True))
-    scr.db.close()
+    scr.close()